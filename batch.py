@@ -0,0 +1,184 @@
+import json
+import shlex
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from file_operations import (
+    upload,
+    download,
+    list_files,
+    delete,
+    usage_report,
+    cache_stats,
+)
+from logger import logger
+
+USAGE = {
+    "upload": "upload FILE_PATH [--name NAME] [--delta]",
+    "download": "download FILE_NAME DOWNLOAD_DIR [--version N]",
+    "list": "list",
+    "delete": "delete FILE_NAME",
+    "usage": "usage",
+}
+
+
+def parse_command(line):
+    """Parse one batch line into a command dict.
+
+    Lines are either JSON objects such as
+    {"op": "download", "file_name": "a.txt", "download_dir": "out"}
+    or shell-style words such as: download a.txt out
+    """
+    line = line.strip()
+    if line.startswith("{"):
+        command = json.loads(line)
+        if not isinstance(command, dict) or command.get("op") not in USAGE:
+            raise ValueError(f"Unknown command: {line}")
+        return command
+
+    words = shlex.split(line)
+    op, args = words[0], words[1:]
+    options = {}
+    for op_name, option in (("upload", "--name"), ("download", "--version")):
+        if op == op_name and option in args:
+            i = args.index(option)
+            if i + 1 >= len(args):
+                raise ValueError(f"Usage: {USAGE[op]}")
+            options[option] = args[i + 1]
+            del args[i : i + 2]
+    delta = op == "upload" and "--delta" in args
+    if delta:
+        args.remove("--delta")
+    expected = {"upload": 1, "download": 2, "list": 0, "delete": 1, "usage": 0}
+    if op not in expected:
+        raise ValueError(f"Unknown command: {op}")
+    if len(args) != expected[op]:
+        raise ValueError(f"Usage: {USAGE[op]}")
+
+    if op == "upload":
+        command = {"op": op, "file_path": args[0], "name": options.get("--name")}
+        if delta:
+            command["delta"] = True
+        return command
+    if op == "download":
+        command = {"op": op, "file_name": args[0], "download_dir": args[1]}
+        if "--version" in options:
+            command["version"] = int(options["--version"])
+        return command
+    if op == "delete":
+        return {"op": op, "file_name": args[0]}
+    return {"op": op}
+
+
+def run_command(command, storage_dir):
+    """Execute a parsed command and return its JSON-serialisable result."""
+    op = command["op"]
+    result = {"op": op}
+    if "id" in command:
+        result["id"] = command["id"]
+    try:
+        if op == "upload":
+            if command["file_path"] == "-":
+                raise ValueError("stdin uploads are not supported in batch mode.")
+            result["version"] = upload(
+                command["file_path"],
+                storage_dir,
+                file_name=command.get("name"),
+                delta=command.get("delta", False),
+            )
+        elif op == "download":
+            if command["download_dir"] == "-":
+                raise ValueError("stdout downloads are not supported in batch mode.")
+            download(
+                command["file_name"],
+                command["download_dir"],
+                storage_dir,
+                version=command.get("version"),
+            )
+        elif op == "list":
+            result["files"] = list_files(storage_dir)
+        elif op == "delete":
+            delete(command["file_name"], storage_dir)
+        elif op == "usage":
+            result["usage"] = usage_report(storage_dir)
+        result["ok"] = True
+    except Exception as e:
+        logger.error(f"Batch {op} error: {e}")
+        result["ok"] = False
+        result["error"] = str(e)
+    return result
+
+
+def _run_line(line, storage_dir):
+    try:
+        command = parse_command(line)
+    except (ValueError, KeyError) as e:
+        return {"ok": False, "error": f"Invalid command: {e}"}
+    return run_command(command, storage_dir)
+
+
+def run_batch(lines, storage_dir, jobs=1, out=None):
+    """Run every non-empty, non-comment line and write one JSON result per line.
+
+    With jobs > 1 commands run concurrently; results are still written in
+    input order. Returns the number of failed commands.
+    """
+    out = out or sys.stdout
+    jobs = max(1, jobs)
+    failures = 0
+
+    def emit(future):
+        nonlocal failures
+        result = future.result()
+        failures += not result["ok"]
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+
+    # Keep a bounded window of in-flight commands so results stream out while
+    # the input (possibly a pipe) is still being read.
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for line in lines:
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            pending.append(executor.submit(_run_line, line, storage_dir))
+            if len(pending) >= jobs * 2:
+                emit(pending.popleft())
+        while pending:
+            emit(pending.popleft())
+    logger.info(f"Batch finished with {failures} failed command(s).")
+    if cache_stats() is not None:
+        logger.info(f"Object cache: {cache_stats()}")
+    return failures
+
+
+def run_shell(storage_dir, check_session=None):
+    """Interactive prompt running the same commands as batch mode."""
+    try:
+        import readline  # noqa: F401  (line editing and history where available)
+    except ImportError:
+        pass
+
+    print('SFSS shell. Type "help" for commands, "exit" to quit.')
+    while True:
+        try:
+            line = input("sfss> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        if not line:
+            continue
+        if line in ("exit", "quit"):
+            break
+        if line == "help":
+            for usage in USAGE.values():
+                print(f"  {usage}")
+            print("  stats")
+            continue
+        if line == "stats":
+            print(json.dumps({"cache": cache_stats()}))
+            continue
+        if check_session and not check_session():
+            print('Session expired. Run "auth" again to continue.')
+            break
+        print(json.dumps(_run_line(line, storage_dir)))
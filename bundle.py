@@ -0,0 +1,422 @@
+import hashlib
+import io
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+from cryptography.fernet import Fernet
+from config import Config
+from encryption import (
+    get_fernet,
+    chunk_id,
+    read_chunk,
+    EncryptingReader,
+    DecryptingWriter,
+)
+from logger import logger
+from metrics import phase, add_bytes
+from usage import update_usage
+from versions import (
+    META_PREFIX,
+    LEGACY_VERSION,
+    bounded_map,
+    chunk_key,
+    manifest_key,
+    list_objects,
+    list_versions,
+    read_manifest,
+    read_chunk_data,
+    store_manifest,
+    lock_store,
+)
+
+# A bundle is one file holding a user's whole store, encrypted under its own
+# key so it can be moved without the store's aes.key:
+#
+#   BUNDLE_MAGIC
+#   record*       8-byte length + Fernet token of
+#                 (4-byte header length, JSON header, payload)
+#   index record  header {"type": "index", ...}, lists every record's offset
+#   trailer       8-byte offset of the index record + BUNDLE_MAGIC
+#
+# Records are chunks first, then manifests, then legacy objects (split into
+# frames), so a bundle can be imported from a pipe in one pass. The index
+# makes it seekable, and lists everything the bundle and the bundles it is
+# based on cover, which is what an incremental export leaves out.
+BUNDLE_MAGIC = b"SFSB\x01"
+_RECORD_LEN = struct.Struct(">Q")
+_HEADER_LEN = struct.Struct(">I")
+
+# Maps chunk ids of imported bundles to chunk ids in this store, for stores
+# whose aes.key differs from the exporting one.
+IMPORT_MAP_KEY = f"{META_PREFIX}/import-map"
+
+
+def _content_id(chunks):
+    # Chunk ids are keyed hashes of the plaintext, so equal lists mean equal
+    # content; version numbers alone are reused once a deletion is purged
+    return hashlib.sha256(json.dumps(chunks).encode()).hexdigest()
+
+
+def load_bundle_key(path, create=False):
+    """Read a bundle key file, generating a new key first if `create` is set."""
+    if create and not os.path.exists(path):
+        key = Fernet.generate_key()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        logger.info(f"Bundle key generated: {path}")
+        return key
+    with open(path, "rb") as f:
+        return f.read().strip()
+
+
+class _BundleWriter:
+    def __init__(self, dest, fernet):
+        self._dest = dest
+        self._fernet = fernet
+        self.offset = 0
+        self.entries = []
+        self._write(BUNDLE_MAGIC)
+
+    def _write(self, data):
+        with phase("sink_write"):
+            self._dest.write(data)
+        self.offset += len(data)
+        add_bytes("bundle", len(data))
+
+    def encrypt(self, header, payload=b""):
+        header = json.dumps(header).encode()
+        with phase("encrypt"):
+            return self._fernet.encrypt(
+                _HEADER_LEN.pack(len(header)) + header + payload
+            )
+
+    def write_record(self, entry, token):
+        self.entries.append(entry + [self.offset])
+        self._write(_RECORD_LEN.pack(len(token)) + token)
+
+    def finish(self, index):
+        offset = self.offset
+        self._write(_RECORD_LEN.pack(len(index)) + index)
+        self._write(_RECORD_LEN.pack(offset) + BUNDLE_MAGIC)
+
+
+class _LegacyFrames(io.RawIOBase):
+    """Writes the plaintext of a legacy object as a series of frame records."""
+
+    def __init__(self, writer, name):
+        self._writer = writer
+        self._name = name
+        self._buffer = bytearray()
+        self._index = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        while len(self._buffer) > Config.ENCRYPTION_CHUNK_SIZE:
+            self._emit(bytes(self._buffer[: Config.ENCRYPTION_CHUNK_SIZE]), False)
+            del self._buffer[: Config.ENCRYPTION_CHUNK_SIZE]
+        return len(b)
+
+    def finish(self):
+        self._emit(bytes(self._buffer), True)
+
+    def _emit(self, data, last):
+        header = {"type": "legacy", "name": self._name, "last": last}
+        token = self._writer.encrypt(header, data)
+        self._writer.write_record(["legacy", self._name, self._index], token)
+        self._index += 1
+
+
+def read_index(path, fernet):
+    """Read the index of a bundle file without reading its records."""
+    with open(path, "rb") as f:
+        f.seek(-(_RECORD_LEN.size + len(BUNDLE_MAGIC)), os.SEEK_END)
+        trailer = f.read()
+        if not trailer.endswith(BUNDLE_MAGIC):
+            raise ValueError("Not a complete bundle.")
+        (offset,) = _RECORD_LEN.unpack_from(trailer)
+        f.seek(offset)
+        header, _ = _read_record(f, fernet)
+    if header["type"] != "index":
+        raise ValueError("Not a complete bundle.")
+    return header
+
+
+def export_bundle(dest, storage_dir, fernet, backend, since=None):
+    """Write every object of `storage_dir` to `dest` as a bundle.
+
+    `since` is the index of a previous bundle; what it covers is left out.
+    Chunks are read and re-encrypted in parallel, at most a small window of
+    them at a time.
+    """
+    covered_chunks = set(since["chunks"]) if since else set()
+    # Indexes of bundles made before content ids were recorded list versions
+    # as [name, version]; those versions are exported again
+    covered_versions = {
+        (v[0], v[1]): v[2] for v in (since["versions"] if since else []) if len(v) > 2
+    }
+    covered_legacy = dict(since["legacy"]) if since else {}
+    writer = _BundleWriter(dest, fernet)
+    stats = {"chunks": 0, "versions": 0, "legacy": 0}
+
+    with lock_store(shared=True):
+        manifests = []
+        legacy = {}
+        for name in list_objects(storage_dir, backend):
+            for version in list_versions(name, storage_dir, backend):
+                if version == LEGACY_VERSION:
+                    info = backend.stat(storage_dir, name)
+                    if info is not None:
+                        legacy[name] = info.etag
+                else:
+                    manifest = read_manifest(name, version, storage_dir, backend)
+                    content = _content_id(manifest["chunks"])
+                    if covered_versions.get((name, version)) != content:
+                        manifests.append(manifest)
+                        covered_versions[(name, version)] = content
+
+        chunks = []
+        for manifest in manifests:
+            for cid, _ in manifest["chunks"]:
+                if cid not in covered_chunks:
+                    chunks.append(cid)
+                    covered_chunks.add(cid)
+
+        def reencrypt(cid):
+            data = read_chunk_data(cid, storage_dir, backend)
+            return cid, writer.encrypt({"type": "chunk", "id": cid}, data)
+
+        for cid, token in bounded_map(reencrypt, chunks, Config.CHUNK_CONCURRENCY):
+            writer.write_record(["chunk", cid], token)
+            stats["chunks"] += 1
+
+        for manifest in manifests:
+            token = writer.encrypt({"type": "manifest"}, json.dumps(manifest).encode())
+            writer.write_record(
+                ["manifest", manifest["name"], manifest["version"]], token
+            )
+            stats["versions"] += 1
+
+        for name, etag in legacy.items():
+            if covered_legacy.get(name) == etag:
+                continue
+            frames = _LegacyFrames(writer, name)
+            decrypting = DecryptingWriter(frames)
+            backend.read(storage_dir, name, decrypting)
+            decrypting.close()
+            frames.finish()
+            covered_legacy[name] = etag
+            stats["legacy"] += 1
+
+    index = {
+        "type": "index",
+        "created": time.time(),
+        "entries": writer.entries,
+        "chunks": sorted(covered_chunks),
+        "versions": sorted([*v, c] for v, c in covered_versions.items()),
+        "legacy": covered_legacy,
+    }
+    writer.finish(writer.encrypt(index))
+    stats["bytes"] = writer.offset
+    logger.info(
+        f"Exported {stats['versions']} version(s), {stats['chunks']} chunk(s) "
+        f"and {stats['legacy']} legacy object(s), {stats['bytes']} bytes."
+    )
+    return stats
+
+
+def _read_record(source, fernet):
+    prefix = read_chunk(source, _RECORD_LEN.size)
+    if len(prefix) < _RECORD_LEN.size:
+        raise ValueError("Bundle is truncated.")
+    (length,) = _RECORD_LEN.unpack(prefix)
+    token = read_chunk(source, length)
+    if len(token) < length:
+        raise ValueError("Bundle is truncated.")
+    with phase("decrypt"):
+        record = fernet.decrypt(token)
+    (header_len,) = _HEADER_LEN.unpack_from(record)
+    end = _HEADER_LEN.size + header_len
+    return json.loads(record[_HEADER_LEN.size : end]), record[end:]
+
+
+def _iter_records(source, fernet):
+    if read_chunk(source, len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+        raise ValueError("Not a bundle.")
+    while True:
+        header, payload = _read_record(source, fernet)
+        if header["type"] == "index":
+            return
+        yield header, payload
+
+
+class _FrameReader(io.RawIOBase):
+    """Readable plaintext of consecutive legacy frame records."""
+
+    def __init__(self, first, records, reserve=None):
+        self._pending = first[1]
+        self._done = first[0]["last"]
+        self._records = records
+        self._reserve = reserve
+        if reserve is not None:
+            reserve(len(self._pending))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending and not self._done:
+            header, self._pending = next(self._records)
+            self._done = header["last"]
+            if self._reserve is not None:
+                self._reserve(len(self._pending))
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def import_bundle(source, storage_dir, fernet, backend, reserve=None):
+    """Add every object of a bundle to `storage_dir`.
+
+    Versions that already exist are kept as they are; a version whose number
+    is taken by different content is stored under the next free number.
+    Incremental bundles must be imported after the bundles they are based on.
+
+    `reserve`, if given, is called with a byte count before new chunks,
+    versions and legacy objects are stored, and may raise to abort the
+    import. What was imported up to then is added to the usage counters
+    either way.
+    """
+    store_fernet = get_fernet()
+    mapping = {}
+    if backend.exists(storage_dir, IMPORT_MAP_KEY):
+        buf = io.BytesIO()
+        backend.read(storage_dir, IMPORT_MAP_KEY, buf)
+        mapping = json.loads(store_fernet.decrypt(buf.getvalue()))
+    remapped = False
+    stats = {"chunks": 0, "versions": 0, "legacy": 0}
+    usage = {"objects": 0, "logical_bytes": 0, "stored_bytes": 0}
+    records = _iter_records(source, fernet)
+    rest = []
+    reserved = 0
+    reserved_lock = threading.Lock()
+
+    def claim(n):
+        nonlocal reserved
+        if reserve is not None:
+            reserve(n)
+        with reserved_lock:
+            reserved += n
+
+    def claim_logical(n):
+        # New chunks were claimed as they were stored; only claim the part of
+        # a version's size they do not already cover
+        claim(max(0, usage["logical_bytes"] + n - reserved))
+
+    def chunk_records():
+        for header, payload in records:
+            if header["type"] != "chunk":
+                rest.append((header, payload))
+                return
+            yield header, payload
+
+    def store_chunk(record):
+        header, data = record
+        with phase("hash"):
+            cid = chunk_id(data)
+        key = chunk_key(cid)
+        stored = 0
+        if not backend.exists(storage_dir, key):
+            claim(len(data))
+            with phase("encrypt"):
+                token = store_fernet.encrypt(data)
+            backend.write(storage_dir, key, io.BytesIO(token))
+            stored = len(token)
+        return header["id"], cid, stored
+
+    def is_new(name):
+        return not list_versions(name, storage_dir, backend)
+
+    def has_content(name, chunks):
+        return any(
+            read_manifest(name, v, storage_dir, backend).get("chunks") == chunks
+            for v in list_versions(name, storage_dir, backend)
+            if v != LEGACY_VERSION
+        )
+
+    with lock_store(shared=True):
+        try:
+            for old, new, stored in bounded_map(
+                store_chunk, chunk_records(), Config.CHUNK_CONCURRENCY
+            ):
+                if old != new:
+                    mapping[old] = new
+                    remapped = True
+                usage["stored_bytes"] += stored
+                stats["chunks"] += 1
+
+            for header, payload in itertools.chain(rest, records):
+                if header["type"] == "manifest":
+                    manifest = json.loads(payload)
+                    name, version = manifest["name"], manifest["version"]
+                    manifest["chunks"] = [
+                        [mapping.get(cid, cid), length]
+                        for cid, length in manifest["chunks"]
+                    ]
+                    if backend.exists(storage_dir, manifest_key(name, version)):
+                        if has_content(name, manifest["chunks"]):
+                            logger.info(f"Version {version} of {name} exists, skipped.")
+                            continue
+                        logger.info(
+                            f"Version {version} of {name} is taken, renumbered."
+                        )
+                    for cid, _ in manifest["chunks"]:
+                        if not backend.exists(storage_dir, chunk_key(cid)):
+                            raise ValueError(
+                                f"Chunk {cid} of {name} is missing; import the bundle "
+                                "this one is based on first."
+                            )
+                    claim_logical(manifest["size"])
+                    created = is_new(name)
+                    stored = store_manifest(manifest, storage_dir, backend)
+                    usage["objects"] += created
+                    usage["logical_bytes"] += manifest["size"]
+                    usage["stored_bytes"] += stored
+                    stats["versions"] += 1
+                elif header["type"] == "legacy":
+                    name = header["name"]
+                    if backend.exists(storage_dir, name):
+                        logger.info(f"Legacy object {name} exists, skipped.")
+                        reader = _FrameReader((header, payload), records)
+                        while reader.read(Config.IO_BUFFER_SIZE):
+                            pass
+                        continue
+                    reader = _FrameReader((header, payload), records, reserve=claim)
+                    created = is_new(name)
+                    backend.write(storage_dir, name, EncryptingReader(reader))
+                    usage["objects"] += created
+                    size = backend.stat(storage_dir, name).size
+                    usage["logical_bytes"] += size
+                    usage["stored_bytes"] += size
+                    stats["legacy"] += 1
+        finally:
+            # Account for everything stored, also when the import was aborted
+            if remapped:
+                token = store_fernet.encrypt(json.dumps(mapping).encode())
+                old = backend.stat(storage_dir, IMPORT_MAP_KEY)
+                backend.write(storage_dir, IMPORT_MAP_KEY, io.BytesIO(token))
+                usage["stored_bytes"] += len(token) - (old.size if old else 0)
+            update_usage(storage_dir, **usage)
+
+    logger.info(
+        f"Imported {stats['versions']} version(s), {stats['chunks']} chunk(s) "
+        f"and {stats['legacy']} legacy object(s)."
+    )
+    return stats, usage
@@ -23,3 +23,60 @@ class Config:
     ACTIVE_USER_FILE = os.path.join(BASE_DIR, "active_user.txt")
     LOG_FILE = os.path.join(BASE_DIR, "sfss.log")  # Location to say logging data
     AES_KEY_FILE = os.path.join(BASE_DIR, "aes.key")
+    USAGE_DIR = os.path.join(BASE_DIR, "usage")  # Per-user usage counters
+    # Held shared by uploads and exclusively by garbage collection, so a chunk
+    # reused by an upload in one process is never collected by another
+    STORE_LOCK_FILE = os.path.join(BASE_DIR, "store.lock")
+    IO_BUFFER_SIZE = 1024 * 1024  # Read/write buffer used when streaming objects
+    # fsync local objects before renaming them into place (durable, but slower)
+    FSYNC = os.getenv("SFSS_FSYNC", "0") == "1"
+    ENCRYPTION_CHUNK_SIZE = 1024 * 1024  # Plaintext bytes per encrypted frame
+
+    # Storage backend: "local" keeps objects under STORAGE_DIR, "s3" uses an
+    # S3-compatible object store (AWS, MinIO, moto server, ...).
+    STORAGE_BACKEND = os.getenv("SFSS_STORAGE_BACKEND", "local")
+    S3_BUCKET = os.getenv("SFSS_S3_BUCKET")
+    S3_ENDPOINT_URL = os.getenv("SFSS_S3_ENDPOINT_URL")  # Leave unset for AWS
+    S3_REGION = os.getenv("SFSS_S3_REGION", "us-east-1")
+    S3_MAX_POOL_CONNECTIONS = int(os.getenv("SFSS_S3_MAX_POOL_CONNECTIONS", "32"))
+    S3_MAX_CONCURRENCY = int(os.getenv("SFSS_S3_MAX_CONCURRENCY", "10"))
+    S3_MULTIPART_CHUNKSIZE = int(
+        os.getenv("SFSS_S3_MULTIPART_CHUNKSIZE", str(8 * 1024 * 1024))
+    )
+
+    # Byte budget of the in-memory cache of decrypted objects used by
+    # long-lived processes (batch/shell). 0 disables the cache.
+    CACHE_MAX_BYTES = int(os.getenv("SFSS_CACHE_MAX_BYTES", "0"))
+
+    # Versioned objects are split into CHUNK_SIZE plaintext chunks; unchanged
+    # chunks are shared between versions instead of being stored again.
+    CHUNK_SIZE = int(os.getenv("SFSS_CHUNK_SIZE", str(4 * 1024 * 1024)))
+    # Delta uploads store files in smaller blocks, so a small edit only costs
+    # one block and finding data that moved rolls over at most one block
+    DELTA_BLOCK_SIZE = int(os.getenv("SFSS_DELTA_BLOCK_SIZE", str(64 * 1024)))
+    # Chunks are transferred with one request each, CHUNK_CONCURRENCY at a
+    # time; on S3 that is where transfer parallelism comes from.
+    CHUNK_CONCURRENCY = int(
+        os.getenv(
+            "SFSS_CHUNK_CONCURRENCY",
+            str(S3_MAX_CONCURRENCY if STORAGE_BACKEND == "s3" else 4),
+        )
+    )
+    # Retention: keep the newest KEEP_VERSIONS versions (0 = all) and drop
+    # versions older than KEEP_DAYS days (0 = no age limit). The latest
+    # version is always kept.
+    KEEP_VERSIONS = int(os.getenv("SFSS_KEEP_VERSIONS", "10"))
+    KEEP_DAYS = float(os.getenv("SFSS_KEEP_DAYS", "0"))
+    PRUNE_INTERVAL = int(os.getenv("SFSS_PRUNE_INTERVAL", "300"))  # Seconds
+    # Unreferenced chunks younger than this may belong to an upload in flight
+    GC_GRACE_SECONDS = int(os.getenv("SFSS_GC_GRACE_SECONDS", "3600"))
+    # Deleted files stay in the trash, and can be undeleted, for this long
+    TRASH_GRACE_SECONDS = int(os.getenv("SFSS_TRASH_GRACE_SECONDS", str(7 * 86400)))
+    # Keys per second the trash purge may delete (0 = no limit)
+    PURGE_RATE = float(os.getenv("SFSS_PURGE_RATE", "200"))
+
+    # Per-user quotas on logical (plaintext) bytes, including old versions.
+    # QUOTAS_FILE maps usernames to byte limits, e.g. {"alice": 10737418240};
+    # users not listed get DEFAULT_QUOTA_BYTES (0 = unlimited).
+    QUOTAS_FILE = os.path.join(BASE_DIR, "quotas.json")
+    DEFAULT_QUOTA_BYTES = int(os.getenv("SFSS_DEFAULT_QUOTA_BYTES", "0"))
@@ -0,0 +1,109 @@
+import zlib
+from encryption import chunk_id, read_chunk
+
+# rsync-style block matching. Every manifest records a weak checksum
+# (Adler-32) of each chunk next to its chunk id. A delta upload slides a
+# window of one block over the new data, rolling the weak checksum one byte
+# at a time, and confirms weak hits with the chunk id before reusing a block.
+_MOD = 65521
+
+
+def weak_checksum(data):
+    return zlib.adler32(data)
+
+
+def signatures(manifest, block_size):
+    """Map weak checksums of a version's full-size blocks to their chunk ids.
+
+    Returns None for manifests written before weak checksums were recorded.
+    """
+    if "weak" not in manifest:
+        return None
+    result = {}
+    for (cid, length), weak in zip(manifest["chunks"], manifest["weak"]):
+        if length == block_size:
+            result.setdefault(weak, set()).add(cid)
+    return result
+
+
+def delta_chunks(source, known, block_size):
+    """Split `source` into blocks found in `known` and new data in between.
+
+    Blocks are matched at any offset, so data shifted by an insertion is
+    still reused. Yields [cid, length, weak] for each matched block and bytes
+    (at most block_size at a time) for everything else.
+    """
+    buf = bytearray()
+    pos = 0
+    eof = False
+    literal = bytearray()
+
+    def fill(need):
+        # Keep at least `need` bytes buffered from pos, while the source lasts
+        nonlocal pos, eof
+        if pos >= block_size:
+            del buf[:pos]
+            pos = 0
+        while not eof and len(buf) - pos < need:
+            data = read_chunk(source, block_size)
+            buf.extend(data)
+            eof = len(data) < block_size
+
+    def match(at, weak):
+        cids = known.get(weak)
+        if cids:
+            cid = chunk_id(bytes(buf[at : at + block_size]))
+            if cid in cids:
+                return cid
+        return None
+
+    while True:
+        fill(2 * block_size + 1)
+        if len(buf) - pos < block_size:
+            break
+        weak = weak_checksum(buf[pos : pos + block_size])
+        cid = match(pos, weak)
+        if cid is None and len(buf) - pos >= 2 * block_size:
+            # Most edits change data in place, so the next block is usually
+            # unchanged and where it was; try it before searching byte by byte
+            after = pos + block_size
+            next_weak = weak_checksum(buf[after : after + block_size])
+            next_cid = match(after, next_weak)
+            if next_cid is not None:
+                yield bytes(buf[pos:after])
+                yield [next_cid, block_size, next_weak]
+                pos = after + block_size
+                continue
+        while cid is None:
+            if len(buf) - pos <= block_size:
+                fill(block_size + 1)
+                if len(buf) - pos <= block_size:
+                    break
+            # Roll the weak checksum one byte at a time; this loop is the hot path
+            a, b = weak & 0xFFFF, weak >> 16
+            end = min(len(buf) - block_size, pos + block_size - len(literal))
+            start = pos
+            while pos < end:
+                out_byte = buf[pos]
+                a = (a - out_byte + buf[pos + block_size]) % _MOD
+                b = (b - block_size * out_byte + a - 1) % _MOD
+                pos += 1
+                if (b << 16 | a) in known:
+                    break
+            weak = (b << 16) | a
+            literal += buf[start:pos]
+            if len(literal) == block_size:
+                yield bytes(literal)
+                literal.clear()
+            cid = match(pos, weak)
+        if cid is None:
+            break
+        if literal:
+            yield bytes(literal)
+            literal.clear()
+        yield [cid, block_size, weak]
+        pos += block_size
+
+    literal.extend(buf[pos:])
+    for start in range(0, len(literal), block_size):
+        yield bytes(literal[start : start + block_size])
@@ -1,7 +1,12 @@
 from cryptography.fernet import Fernet
+import hashlib
+import hmac
+import io
 import os
+import struct
 from config import Config
 from logger import logger
+from metrics import phase
 
 
 def generate_key():
@@ -10,6 +15,7 @@ def generate_key():
     with open(Config.AES_KEY_FILE, "wb") as key_file:
         key_file.write(key)
     logger.info("AES encryption key generated.")
+    reset_fernet()
     return key
 
 
@@ -21,6 +27,49 @@ def load_key():
     return key
 
 
+_fernet = None
+_chunk_key = None
+
+
+def get_fernet():
+    """Return a Fernet for the stored key, reading the key file only once per process."""
+    global _fernet
+    if _fernet is None:
+        _fernet = Fernet(load_key())
+    return _fernet
+
+
+def reset_fernet():
+    global _fernet, _chunk_key
+    _fernet = None
+    _chunk_key = None
+
+
+def chunk_id(data):
+    """Keyed hash naming a plaintext chunk; equal chunks share one stored copy.
+
+    The hash is keyed so chunk names reveal nothing about their content to
+    anyone without the encryption key.
+    """
+    global _chunk_key
+    if _chunk_key is None:
+        _chunk_key = hmac.new(load_key(), b"sfss-chunk-id", hashlib.sha256).digest()
+    return hmac.new(_chunk_key, data, hashlib.sha256).hexdigest()
+
+
+def read_chunk(source, size):
+    """Read up to `size` bytes, retrying short reads (pipes) until EOF."""
+    parts = []
+    remaining = size
+    while remaining:
+        data = source.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b"".join(parts)
+
+
 def encrypt_file(file_path):
     key = load_key()
     fernet = Fernet(key)
@@ -41,3 +90,123 @@ def decrypt_file(file_path):
     with open(file_path, "wb") as dec_file:
         dec_file.write(decrypted)
     logger.info(f"File decrypted: {file_path}")
+
+
+# Streamed objects start with STREAM_MAGIC followed by length-prefixed frames.
+# Each frame is a Fernet token over (frame index, last-frame flag, data), so
+# frames cannot be reordered, dropped or cut off without decryption failing.
+# Objects without the magic are single Fernet tokens from older versions.
+STREAM_MAGIC = b"SFSS\x01"
+_FRAME_LEN = struct.Struct(">I")
+_FRAME_HEADER = struct.Struct(">QB")
+
+
+class EncryptingReader(io.RawIOBase):
+    """Readable stream of the encrypted form of a plaintext stream."""
+
+    def __init__(self, source, fernet=None, chunk_size=None):
+        self._source = source
+        self._fernet = fernet or get_fernet()
+        self._chunk_size = chunk_size or Config.ENCRYPTION_CHUNK_SIZE
+        self._index = 0
+        self._pending = STREAM_MAGIC
+        self._next_chunk = read_chunk(source, self._chunk_size)
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def _next_frame(self):
+        chunk = self._next_chunk
+        if chunk:
+            self._next_chunk = read_chunk(self._source, self._chunk_size)
+        last = not self._next_chunk
+        with phase("encrypt"):
+            token = self._fernet.encrypt(_FRAME_HEADER.pack(self._index, last) + chunk)
+        self._index += 1
+        self._done = last
+        return _FRAME_LEN.pack(len(token)) + token
+
+    def readinto(self, b):
+        while not self._pending and not self._done:
+            self._pending = self._next_frame()
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+class DecryptingWriter(io.RawIOBase):
+    """Writable stream that decrypts what is written into it to `dest`."""
+
+    def __init__(self, dest, fernet=None):
+        self._dest = dest
+        self._fernet = fernet or get_fernet()
+        self._buffer = bytearray()
+        self._streamed = None  # Unknown until the first bytes arrive
+        self._index = 0
+        self._finished = False
+        self._failed = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        if self._streamed is None and len(self._buffer) >= len(STREAM_MAGIC):
+            self._streamed = self._buffer.startswith(STREAM_MAGIC)
+            if self._streamed:
+                del self._buffer[: len(STREAM_MAGIC)]
+        if self._streamed:
+            try:
+                self._drain()
+            except Exception:
+                self._failed = True
+                raise
+        return len(b)
+
+    def _drain(self):
+        while len(self._buffer) >= _FRAME_LEN.size:
+            (length,) = _FRAME_LEN.unpack_from(self._buffer)
+            end = _FRAME_LEN.size + length
+            if len(self._buffer) < end:
+                return
+            if self._finished:
+                raise ValueError("Unexpected data after the last frame.")
+            with phase("decrypt"):
+                frame = self._fernet.decrypt(bytes(self._buffer[_FRAME_LEN.size : end]))
+            del self._buffer[:end]
+            index, last = _FRAME_HEADER.unpack_from(frame)
+            if index != self._index:
+                raise ValueError("Encrypted stream frames are out of order.")
+            self._dest.write(frame[_FRAME_HEADER.size :])
+            self._index += 1
+            self._finished = bool(last)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._failed:
+                pass
+            elif self._streamed:
+                if not self._finished or self._buffer:
+                    raise ValueError("Encrypted stream is truncated.")
+            else:
+                # Legacy single-token object; these were always read whole
+                with phase("decrypt"):
+                    data = self._fernet.decrypt(bytes(self._buffer))
+                self._dest.write(data)
+                self._buffer.clear()
+        finally:
+            super().close()
+
+
+def decrypt_stream(source, dest, fernet=None):
+    writer = DecryptingWriter(dest, fernet)
+    while True:
+        data = source.read(Config.IO_BUFFER_SIZE)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
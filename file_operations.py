@@ -1,56 +1,439 @@
+import fnmatch
+import io
 import os
-import shutil
-from encryption import encrypt_file, decrypt_file
+import tempfile
+import threading
+import time
+from cryptography.fernet import Fernet
+from bundle import export_bundle, import_bundle, read_index
+from cache import ObjectCache
+from config import Config
+from encryption import DecryptingWriter
+from storage import get_backend
+from versions import (
+    META_PREFIX,
+    LEGACY_VERSION,
+    write_version,
+    read_version,
+    read_manifest,
+    list_objects,
+    list_versions,
+    manifest_key,
+    prune_versions,
+    collect_garbage,
+    new_trash_id,
+    trash_object,
+    list_trash,
+    restore_object,
+    purge_trash,
+    lock_store,
+)
+from usage import get_usage, get_quota, update_usage, reservation, reconcile
 from logger import logger
+from metrics import timed, phase, add_bytes
+
+# Optional in-memory cache of decrypted objects, see enable_cache()
+_cache = None
+
+
+def enable_cache(max_bytes):
+    """Cache up to `max_bytes` of decrypted objects in memory for this process."""
+    global _cache
+    _cache = ObjectCache(max_bytes)
+    logger.info(f"Object cache enabled ({max_bytes} bytes).")
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+def cache_stats():
+    return _cache.stats() if _cache is not None else None
+
+
+class _CachingWriter(io.RawIOBase):
+    """Passes writes through to `dest` while collecting them for the cache."""
+
+    def __init__(self, dest, limit):
+        self._dest = dest
+        self._limit = limit
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._dest.write(b)
+        if self.buffer is not None:
+            self.buffer.write(b)
+            if self.buffer.tell() > self._limit:
+                self.buffer = None  # Too big to cache, stop collecting
+        return len(b)
 
 
 def sanitize_path(file_name, storage_dir):
     # Prevent path traversal
     if ".." in file_name or file_name.startswith("/"):
         raise ValueError("Invalid file name.")
+    # Names are a single path component; .sfss* is reserved for internal data
+    if not file_name or "/" in file_name or "\\" in file_name:
+        raise ValueError("Invalid file name.")
+    if file_name.startswith(META_PREFIX):
+        raise ValueError("Invalid file name.")
     return os.path.join(storage_dir, file_name)
 
 
-def upload(file_path, storage_dir):
+@timed("upload")
+def upload_stream(source, file_name, storage_dir, backend=None, size=None, delta=False):
+    """Encrypt everything readable from `source` as a new version of `file_name`.
+
+    The quota is checked against `size` up front when it is known, otherwise
+    chunk by chunk as the source is read. `delta` only stores the blocks that
+    differ from the latest version, wherever they moved to.
+    """
+    backend = backend or get_backend()
+    sanitize_path(file_name, storage_dir)
+    with reservation(storage_dir) as reserve:
+        if size is not None:
+            reserve(size)
+        manifest, stored, created = write_version(
+            source,
+            file_name,
+            storage_dir,
+            backend,
+            reserve=reserve if size is None else None,
+            delta=delta,
+        )
+        update_usage(
+            storage_dir,
+            objects=1 if created else 0,
+            logical_bytes=manifest["size"],
+            stored_bytes=stored,
+        )
+    if _cache is not None:
+        _cache.invalidate(storage_dir, file_name)
+    # Dropping old manifests is cheap; their chunks are reclaimed by `prune`
+    pruned = prune_versions(storage_dir, backend, name=file_name)
+    if pruned["versions"]:
+        update_usage(
+            storage_dir,
+            logical_bytes=-pruned["logical_bytes"],
+            stored_bytes=-pruned["stored_bytes"],
+        )
+    logger.info(f"File uploaded: {file_name}")
+    return manifest["version"]
+
+
+@timed("upload")
+def upload(file_path, storage_dir, backend=None, file_name=None, delta=False):
     if not os.path.isfile(file_path):
         logger.error("Upload failed: File does not exist.")
         raise FileNotFoundError("File does not exist.")
-    os.makedirs(storage_dir, exist_ok=True)
-    file_name = os.path.basename(file_path)
-    dest_path = sanitize_path(file_name, storage_dir)
-    shutil.copy(file_path, dest_path)
-    encrypt_file(dest_path)
-    logger.info(f"File uploaded: {file_name}")
+    with open(file_path, "rb") as f:
+        return upload_stream(
+            f,
+            file_name or os.path.basename(file_path),
+            storage_dir,
+            backend,
+            size=os.fstat(f.fileno()).st_size,
+            delta=delta,
+        )
 
 
-def download(file_name, download_dir, storage_dir):
-    dest_path = sanitize_path(file_name, storage_dir)
-    if not os.path.exists(dest_path):
+@timed("download")
+def download_stream(file_name, dest, storage_dir, backend=None, version=None):
+    """Decrypt a version (default: the latest) of `file_name` into `dest`."""
+    backend = backend or get_backend()
+    sanitize_path(file_name, storage_dir)
+    versions = list_versions(file_name, storage_dir, backend)
+    if not versions:
         logger.error("Download failed: File does not exist.")
         raise FileNotFoundError("File does not exist.")
-    decrypt_file(dest_path)
-    if not os.path.exists(download_dir):
-        os.makedirs(download_dir, exist_ok=True)
-    shutil.copy(dest_path, os.path.join(download_dir, file_name))
-    encrypt_file(dest_path)
+    if version is None:
+        version = versions[-1]
+    elif version not in versions:
+        logger.error("Download failed: Version does not exist.")
+        raise FileNotFoundError("Version does not exist.")
+
+    cache = _cache
+    if cache is not None:
+        # Version numbers can be reused once an object is deleted and purged;
+        # the etag of the manifest (or legacy object) changes with the content
+        key = (
+            file_name if version == LEGACY_VERSION else manifest_key(file_name, version)
+        )
+        info = backend.stat(storage_dir, key)
+        if info is None:
+            logger.error("Download failed: Version does not exist.")
+            raise FileNotFoundError("Version does not exist.")
+        cache_key = (storage_dir, file_name, info.etag)
+        data = cache.get(cache_key)
+        if data is not None:
+            with phase("sink_write"):
+                dest.write(data)
+            add_bytes("cached", len(data))
+            return
+        collector = _CachingWriter(dest, cache.max_bytes)
+    else:
+        collector = dest
+
+    if version == LEGACY_VERSION:
+        writer = DecryptingWriter(collector)
+        backend.read(storage_dir, file_name, writer)
+        writer.close()
+    else:
+        manifest = read_manifest(file_name, version, storage_dir, backend)
+        read_version(manifest, collector, storage_dir, backend)
+
+    if cache is not None and collector.buffer is not None:
+        cache.put(cache_key, collector.buffer.getvalue())
+
+
+@timed("download")
+def download(file_name, download_dir, storage_dir, backend=None, version=None):
+    os.makedirs(download_dir, exist_ok=True)
+    # Decrypt into a temp file so a failed download leaves no partial plaintext
+    fd, tmp_path = tempfile.mkstemp(dir=download_dir, prefix=".sfss-download-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            download_stream(file_name, f, storage_dir, backend, version)
+        os.replace(tmp_path, os.path.join(download_dir, file_name))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
     logger.info(f"File downloaded: {file_name} to {download_dir}")
 
 
-def list_files(storage_dir):
-    os.makedirs(storage_dir, exist_ok=True)
-    files = [
-        f
-        for f in os.listdir(storage_dir)
-        if os.path.isfile(os.path.join(storage_dir, f))
-    ]
+@timed("list")
+def list_files(storage_dir, backend=None):
+    backend = backend or get_backend()
+    files = list_objects(storage_dir, backend)
     logger.info("Listed files.")
     return files
 
 
-def delete(file_name, storage_dir):
-    file_path = sanitize_path(file_name, storage_dir)
-    if not os.path.exists(file_path):
+@timed("list")
+def list_file_versions(file_name, storage_dir, backend=None):
+    """Version number, size and creation time of each stored version."""
+    backend = backend or get_backend()
+    sanitize_path(file_name, storage_dir)
+    result = []
+    for version in list_versions(file_name, storage_dir, backend):
+        manifest = read_manifest(file_name, version, storage_dir, backend)
+        result.append(
+            {
+                "version": version,
+                "size": manifest.get("size"),
+                "created": manifest["created"],
+            }
+        )
+    return result
+
+
+def _trash(names, storage_dir, backend):
+    # Trashed files still take up space until purged, but no longer count
+    # towards the quota
+    trash_id = new_trash_id()
+    trashed = logical = 0
+    with lock_store(shared=True):
+        try:
+            for name in names:
+                logical += trash_object(name, trash_id, storage_dir, backend)
+                trashed += 1
+                if _cache is not None:
+                    _cache.invalidate(storage_dir, name)
+                logger.info(f"File deleted: {name}")
+        finally:
+            # One counter update for the whole batch, even if it stopped early
+            if trashed:
+                update_usage(storage_dir, objects=-trashed, logical_bytes=-logical)
+
+
+@timed("delete")
+def delete(file_name, storage_dir, backend=None):
+    """Move every version of `file_name` to the trash."""
+    backend = backend or get_backend()
+    sanitize_path(file_name, storage_dir)
+    if not list_versions(file_name, storage_dir, backend):
         logger.error("Delete failed: File does not exist.")
         raise FileNotFoundError("File does not exist.")
-    os.remove(file_path)
-    logger.info(f"File deleted: {file_name}")
+    _trash([file_name], storage_dir, backend)
+
+
+def _last_modified(name, storage_dir, backend):
+    version = list_versions(name, storage_dir, backend)[-1]
+    key = name if version == LEGACY_VERSION else manifest_key(name, version)
+    info = backend.stat(storage_dir, key)
+    return info.modified if info else None
+
+
+def _select(names, patterns):
+    """Names matching a pattern in `patterns`, in order.
+
+    A pattern that is itself one of `names` is taken literally, so a file
+    called e.g. "report[1].txt" is never mistaken for a glob.
+    """
+    literal = set(patterns) & set(names)
+    globs = [p for p in patterns if p not in literal]
+    return [
+        name
+        for name in names
+        if name in literal or any(fnmatch.fnmatchcase(name, p) for p in globs)
+    ]
+
+
+@timed("delete")
+def delete_matching(patterns, storage_dir, backend=None, prefix=None, older_than=None):
+    """Move files matching a glob in `patterns`, or starting with `prefix`, to the trash.
+
+    A pattern naming an existing file deletes just that file. With
+    `older_than`, only files last uploaded more than that many seconds ago
+    are deleted. Returns the names deleted.
+    """
+    backend = backend or get_backend()
+    now = time.time()
+    objects = list_objects(storage_dir, backend)
+    matched = set(_select(objects, patterns))
+    names = []
+    for name in objects:
+        if name not in matched and not (prefix and name.startswith(prefix)):
+            continue
+        if older_than is not None:
+            modified = _last_modified(name, storage_dir, backend)
+            if modified is None or now - modified < older_than:
+                continue
+        names.append(name)
+    _trash(names, storage_dir, backend)
+    logger.info(f"Deleted {len(names)} file(s).")
+    return names
+
+
+@timed("undelete")
+def undelete(patterns, storage_dir, backend=None):
+    """Restore the latest deleted copy of each file matching a glob in `patterns`.
+
+    A pattern naming a deleted file restores just that file. Returns the
+    names restored.
+    """
+    backend = backend or get_backend()
+    trash = list_trash(storage_dir, backend)
+    matched = set(_select([entry["name"] for entry in trash], patterns))
+    latest = {}
+    for entry in trash:
+        if entry["name"] in matched:
+            latest[entry["name"]] = entry
+    if not latest:
+        logger.error("Undelete failed: No deleted file matches.")
+        raise FileNotFoundError("No deleted file matches.")
+    restored = logical = 0
+    with lock_store(shared=True):
+        try:
+            for name, entry in sorted(latest.items()):
+                logical += restore_object(entry, storage_dir, backend)
+                restored += 1
+                logger.info(f"File restored: {name}")
+        finally:
+            if restored:
+                update_usage(storage_dir, objects=restored, logical_bytes=logical)
+    return sorted(latest)
+
+
+@timed("list")
+def list_deleted(storage_dir, backend=None):
+    """Names and deletion times of the files in the trash."""
+    backend = backend or get_backend()
+    return [
+        {"name": entry["name"], "deleted": entry["deleted"]}
+        for entry in list_trash(storage_dir, backend)
+    ]
+
+
+@timed("prune")
+def prune(storage_dir, backend=None):
+    """Apply the retention policy, purge the trash and reclaim unused chunks."""
+    backend = backend or get_backend()
+    pruned = prune_versions(storage_dir, backend)
+    purged, freed = purge_trash(storage_dir, backend)
+    chunks, reclaimed = collect_garbage(storage_dir, backend)
+    update_usage(
+        storage_dir,
+        logical_bytes=-pruned["logical_bytes"],
+        stored_bytes=-(pruned["stored_bytes"] + freed + reclaimed),
+    )
+    removed = pruned["versions"]
+    logger.info(f"Pruned {removed} version(s), reclaimed {reclaimed} bytes.")
+    return {
+        "versions": removed,
+        "purged": purged,
+        "chunks": chunks,
+        "bytes": freed + reclaimed,
+    }
+
+
+def start_background_pruner(storage_dir, backend, interval=None):
+    """Run prune() every `interval` seconds.
+
+    Returns a threading.Event; set it to stop the pruner.
+    """
+    interval = interval or Config.PRUNE_INTERVAL
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                prune(storage_dir, backend)
+            except Exception as e:
+                logger.error(f"Background prune error: {e}")
+
+    threading.Thread(target=run, name="sfss-pruner", daemon=True).start()
+    return stop
+
+
+@timed("export")
+def export_store(dest, storage_dir, bundle_key, backend=None, since=None):
+    """Write every object to `dest` as one bundle encrypted under `bundle_key`.
+
+    `since` is the path of a previous bundle made with the same key; only
+    what changed after it is exported.
+    """
+    backend = backend or get_backend()
+    fernet = Fernet(bundle_key)
+    index = read_index(since, fernet) if since else None
+    stats = export_bundle(dest, storage_dir, fernet, backend, since=index)
+    logger.info("Store exported.")
+    return stats
+
+
+@timed("import")
+def import_store(source, storage_dir, bundle_key, backend=None):
+    """Add every object of a bundle read from `source` to the store.
+
+    The quota is checked as the bundle is read, before each new chunk,
+    version or legacy object is stored.
+    """
+    backend = backend or get_backend()
+    with reservation(storage_dir) as reserve:
+        stats, _ = import_bundle(
+            source, storage_dir, Fernet(bundle_key), backend, reserve=reserve
+        )
+    if _cache is not None:
+        _cache.clear()
+    logger.info("Store imported.")
+    return stats
+
+
+@timed("usage")
+def usage_report(storage_dir):
+    """Usage counters and quota of the current user, read without scanning storage."""
+    return dict(get_usage(storage_dir), quota=get_quota(storage_dir))
+
+
+@timed("reconcile")
+def reconcile_usage(storage_dir, backend=None):
+    """Recount usage from storage and repair the counters."""
+    backend = backend or get_backend()
+    before, after = reconcile(storage_dir, backend)
+    logger.info("Usage reconciled.")
+    return {"before": before, "after": after}
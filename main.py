@@ -1,8 +1,33 @@
 import argparse
 from auth import authenticate, is_authenticated, get_current_user
-from file_operations import upload, download, list_files, delete
+from file_operations import (
+    upload,
+    upload_stream,
+    download,
+    download_stream,
+    list_files,
+    list_file_versions,
+    delete,
+    delete_matching,
+    undelete,
+    list_deleted,
+    prune,
+    usage_report,
+    reconcile_usage,
+    export_store,
+    import_store,
+    enable_cache,
+    start_background_pruner,
+)
+from storage import get_backend
+from usage import QuotaExceededError
+from bundle import load_bundle_key
+from batch import run_batch, run_shell
 from logger import logger
+from metrics import metrics, operation, phase, start_metrics_server
+import atexit
 import os
+import tempfile
 from config import Config
 import sys
 from datetime import datetime
@@ -21,6 +46,28 @@ def init_app():
     print("Application initialized.")
 
 
+def report_metrics(args, profiler=None):
+    """Write the metrics and profile output requested on the command line."""
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile_out)
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
+    if args.profile:
+        print(metrics.format_profile(), file=sys.stderr)
+
+
+def parse_age(value):
+    """Seconds in an age such as 90d, 12h, 30m, 45s or a plain number of seconds."""
+    units = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+    try:
+        if value and value[-1] in units:
+            return float(value[:-1]) * units[value[-1]]
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid age: {value}")
+
+
 def main():
     """Cli entry point"""
     parser = argparse.ArgumentParser(
@@ -28,6 +75,20 @@ def main():
         formatter_class=argparse.RawTextHelpFormatter,
     )
 
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help="Write operation metrics here on exit (JSON for *.json, else Prometheus text)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a per-phase timing breakdown to stderr on exit",
+    )
+    parser.add_argument(
+        "--profile-out", type=str, help="Also write a cProfile dump to this file"
+    )
+
     subparsers = parser.add_subparsers(
         dest="command", help="Available commands", required=True
     )
@@ -42,7 +103,17 @@ def main():
     upload_parser = subparsers.add_parser(
         "upload", help="Upload a file to local storage system"
     )
-    upload_parser.add_argument("file_path", type=str, help="Path of file to upload")
+    upload_parser.add_argument(
+        "file_path", type=str, help="Path of file to upload, or - to read stdin"
+    )
+    upload_parser.add_argument(
+        "--name", type=str, help="Name to store the file under (required with -)"
+    )
+    upload_parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Only store blocks that changed since the last version (large files)",
+    )
 
     # Download command
     download_parser = subparsers.add_parser("download", help="Download a file")
@@ -50,17 +121,132 @@ def main():
         "file_name", type=str, help="Name of the file to download"
     )
     download_parser.add_argument(
-        "download_dir", type=str, help="Directory to download the file to"
+        "download_dir",
+        type=str,
+        help="Directory to download the file to, or - to write to stdout",
+    )
+    download_parser.add_argument(
+        "--version", type=int, help="Version to download (default: latest)"
     )
 
     # List command
     list_parser = subparsers.add_parser("list", help="List all files")
+    list_parser.add_argument(
+        "--versions", action="store_true", help="Also list every stored version"
+    )
+    list_parser.add_argument(
+        "--trash", action="store_true", help="List deleted files instead"
+    )
 
     # Delete command
-    delete_parser = subparsers.add_parser("delete", help="Delete a file")
-    delete_parser.add_argument("file_name", type=str, help="Name of the file to delete")
+    delete_parser = subparsers.add_parser("delete", help="Delete files")
+    delete_parser.add_argument(
+        "file_name",
+        type=str,
+        nargs="*",
+        help="Names or glob patterns (quote them) of the files to delete",
+    )
+    delete_parser.add_argument(
+        "--prefix", type=str, help="Delete every file whose name starts with this"
+    )
+    delete_parser.add_argument(
+        "--older-than",
+        type=parse_age,
+        help="Only delete files last uploaded before this age, e.g. 90d, 12h, 30m",
+    )
+
+    # Undelete command
+    undelete_parser = subparsers.add_parser(
+        "undelete", help="Restore deleted files from the trash"
+    )
+    undelete_parser.add_argument(
+        "file_name", type=str, nargs="+", help="Names or glob patterns to restore"
+    )
+
+    # Prune command
+    prune_parser = subparsers.add_parser(
+        "prune", help="Drop versions outside the retention policy, reclaim space"
+    )
+
+    # Usage command
+    usage_parser = subparsers.add_parser(
+        "usage", help="Show stored objects, bytes used and quota"
+    )
+
+    # Reconcile command
+    reconcile_parser = subparsers.add_parser(
+        "reconcile", help="Recount usage from storage and repair the counters"
+    )
+
+    # Export command
+    export_parser = subparsers.add_parser(
+        "export", help="Write all your files to one encrypted bundle"
+    )
+    export_parser.add_argument(
+        "output", type=str, help="Bundle file to write, or - to write to stdout"
+    )
+    export_parser.add_argument(
+        "--key-file",
+        type=str,
+        help="Bundle key, created if missing (default: OUTPUT.key)",
+    )
+    export_parser.add_argument(
+        "--since", type=str, help="Only export changes since this earlier bundle"
+    )
+
+    # Import command
+    import_parser = subparsers.add_parser(
+        "import", help="Add all files of a bundle to your storage"
+    )
+    import_parser.add_argument(
+        "input", type=str, help="Bundle file to read, or - to read stdin"
+    )
+    import_parser.add_argument(
+        "--key-file", type=str, help="Bundle key (default: INPUT.key)"
+    )
+
+    # Batch command
+    batch_parser = subparsers.add_parser(
+        "batch", help="Run many commands from a file in one process"
+    )
+    batch_parser.add_argument(
+        "source",
+        type=str,
+        help="File with one command per line (plain or JSON), or - for stdin",
+    )
+    batch_parser.add_argument(
+        "--jobs", type=int, default=1, help="Number of commands to run in parallel"
+    )
+
+    # Shell command
+    shell_parser = subparsers.add_parser("shell", help="Interactive command shell")
+
+    for long_lived in (batch_parser, shell_parser):
+        long_lived.add_argument(
+            "--metrics-port",
+            type=int,
+            help="Serve /metrics and /metrics.json on this localhost port",
+        )
 
     args = parser.parse_args()
+    if args.command == "delete" and not args.file_name and not args.prefix:
+        parser.error("give file names, patterns or --prefix")
+    if args.command == "upload" and args.file_path == "-" and not args.name:
+        parser.error("--name is required when uploading from stdin")
+    if args.command in ("export", "import") and not args.key_file:
+        bundle_path = args.output if args.command == "export" else args.input
+        if bundle_path == "-":
+            parser.error("--key-file is required when streaming a bundle")
+        args.key_file = bundle_path + ".key"
+
+    profiler = None
+    if args.profile_out:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.metrics_file or args.profile or profiler:
+        atexit.register(report_metrics, args, profiler)
 
     # List of operations that cli can manage.
     if args.command == "init":
@@ -76,12 +262,15 @@ def main():
         sys.exit(0)  # Exit after authentication
 
     elif args.command:
-        if not is_authenticated():
+        with operation("session"), phase("auth"):
+            authenticated = is_authenticated()
+            current_user = get_current_user() if authenticated else None
+
+        if not authenticated:
             print('You must authenticate first using the "auth" command.')
             logger.warning("Unauthorized access attempt.")
             sys.exit(1)
 
-        current_user = get_current_user()
         if not current_user:
             print("Unable to retrieve current user information.")
             logger.error("Failed to retrieve current user.")
@@ -91,25 +280,76 @@ def main():
         user_storage_dir = os.path.join(Config.STORAGE_DIR, username)
         os.makedirs(user_storage_dir, exist_ok=True)
 
+        # Long-lived modes may keep hot decrypted objects in memory
+        if args.command in ("batch", "shell") and Config.CACHE_MAX_BYTES > 0:
+            enable_cache(Config.CACHE_MAX_BYTES)
+        # ... and apply the retention policy in the background while running
+        if args.command in ("batch", "shell"):
+            start_background_pruner(user_storage_dir, get_backend())
+            if args.metrics_port:
+                start_metrics_server(args.metrics_port)
+
         if args.command == "upload":
             try:
-                upload(args.file_path, user_storage_dir)
+                if args.file_path == "-":
+                    upload_stream(
+                        sys.stdin.buffer, args.name, user_storage_dir, delta=args.delta
+                    )
+                else:
+                    upload(
+                        args.file_path,
+                        user_storage_dir,
+                        file_name=args.name,
+                        delta=args.delta,
+                    )
                 print("File uploaded successfully.")
                 logger.info(f"File uploaded: {args.file_path} by user {username}")
+            except QuotaExceededError as e:
+                logger.error(f"Upload error: {e}")
+                print(f"Upload failed: {e}")
             except Exception as e:
                 logger.error(f"Upload error: {e}")
                 print("Upload failed.")
 
         elif args.command == "download":
+            # Keep stdout clean for the file contents when streaming to it
+            out = sys.stderr if args.download_dir == "-" else sys.stdout
             try:
-                download(args.file_name, args.download_dir, user_storage_dir)
-                print("File downloaded successfully.")
+                if args.download_dir == "-":
+                    download_stream(
+                        args.file_name,
+                        sys.stdout.buffer,
+                        user_storage_dir,
+                        version=args.version,
+                    )
+                    sys.stdout.buffer.flush()
+                else:
+                    download(
+                        args.file_name,
+                        args.download_dir,
+                        user_storage_dir,
+                        version=args.version,
+                    )
+                print("File downloaded successfully.", file=out)
                 logger.info(
                     f"File downloaded: {args.file_name} to {args.download_dir} by user {username}"
                 )
             except Exception as e:
                 logger.error(f"Download error: {e}")
-                print("Download failed.")
+                print("Download failed.", file=out)
+
+        elif args.command == "list" and args.trash:
+            try:
+                print("Deleted Files:")
+                for entry in list_deleted(user_storage_dir):
+                    deleted = datetime.fromtimestamp(entry["deleted"])
+                    print(
+                        f"{entry['name']}  deleted "
+                        f"{deleted.isoformat(timespec='seconds')}"
+                    )
+            except Exception as e:
+                logger.error(f"List error: {e}")
+                print("Failed to list files.")
 
         elif args.command == "list":
             try:
@@ -117,20 +357,157 @@ def main():
                 print("Stored Files:")
                 for f in files:
                     print(f)
+                    if args.versions:
+                        for v in list_file_versions(f, user_storage_dir):
+                            created = datetime.fromtimestamp(v["created"])
+                            size = "?" if v["size"] is None else v["size"]
+                            print(
+                                f"  v{v['version']}  {size} bytes  "
+                                f"{created.isoformat(timespec='seconds')}"
+                            )
                 logger.info(f"Listed files for user {username}.")
             except Exception as e:
                 logger.error(f"List error: {e}")
                 print("Failed to list files.")
 
         elif args.command == "delete":
+            single = (
+                len(args.file_name) == 1
+                and not args.prefix
+                and args.older_than is None
+                and not any(c in args.file_name[0] for c in "*?[")
+            )
             try:
-                delete(args.file_name, user_storage_dir)
-                print("File deleted successfully.")
+                if single:
+                    delete(args.file_name[0], user_storage_dir)
+                    print("File deleted successfully.")
+                else:
+                    deleted = delete_matching(
+                        args.file_name,
+                        user_storage_dir,
+                        prefix=args.prefix,
+                        older_than=args.older_than,
+                    )
+                    print(f"Deleted {len(deleted)} file(s).")
                 logger.info(f"File deleted: {args.file_name} by user {username}")
             except Exception as e:
                 logger.error(f"Delete error: {e}")
                 print("Delete failed.")
 
+        elif args.command == "undelete":
+            try:
+                restored = undelete(args.file_name, user_storage_dir)
+                print(f"Restored {len(restored)} file(s): {', '.join(restored)}")
+                logger.info(f"Files restored: {restored} by user {username}")
+            except Exception as e:
+                logger.error(f"Undelete error: {e}")
+                print(f"Undelete failed: {e}")
+
+        elif args.command == "prune":
+            try:
+                result = prune(user_storage_dir)
+                print(
+                    f"Removed {result['versions']} old version(s), "
+                    f"{result['purged']} deleted file(s) and "
+                    f"{result['chunks']} unused chunk(s), {result['bytes']} bytes."
+                )
+            except Exception as e:
+                logger.error(f"Prune error: {e}")
+                print("Prune failed.")
+
+        elif args.command == "usage":
+            try:
+                usage = usage_report(user_storage_dir)
+                quota = usage["quota"] or "unlimited"
+                print(f"Objects: {usage['objects']}")
+                print(f"Logical bytes: {usage['logical_bytes']} (quota: {quota})")
+                print(f"Stored bytes: {usage['stored_bytes']}")
+            except Exception as e:
+                logger.error(f"Usage error: {e}")
+                print("Failed to read usage.")
+
+        elif args.command == "reconcile":
+            try:
+                result = reconcile_usage(user_storage_dir)
+                before, after = result["before"], result["after"]
+                for counter in ("objects", "logical_bytes", "stored_bytes"):
+                    print(f"{counter}: {before[counter]} -> {after[counter]}")
+            except Exception as e:
+                logger.error(f"Reconcile error: {e}")
+                print("Reconcile failed.")
+
+        elif args.command == "export":
+            # Keep stdout clean for the bundle when streaming to it
+            out = sys.stderr if args.output == "-" else sys.stdout
+            try:
+                key = load_bundle_key(args.key_file, create=True)
+                if args.output == "-":
+                    result = export_store(
+                        sys.stdout.buffer, user_storage_dir, key, since=args.since
+                    )
+                    sys.stdout.buffer.flush()
+                else:
+                    # Write next to the destination so a failed export leaves no partial bundle
+                    fd, tmp_path = tempfile.mkstemp(
+                        dir=os.path.dirname(os.path.abspath(args.output)),
+                        prefix=".sfss-export-",
+                    )
+                    try:
+                        with os.fdopen(fd, "wb") as f:
+                            result = export_store(
+                                f, user_storage_dir, key, since=args.since
+                            )
+                        os.replace(tmp_path, args.output)
+                    except BaseException:
+                        os.remove(tmp_path)
+                        raise
+                print(
+                    f"Exported {result['versions']} version(s) and "
+                    f"{result['legacy']} legacy file(s), {result['bytes']} bytes. "
+                    f"Bundle key: {args.key_file}",
+                    file=out,
+                )
+                logger.info(f"Store exported to {args.output} by user {username}")
+            except Exception as e:
+                logger.error(f"Export error: {e}")
+                print("Export failed.", file=out)
+
+        elif args.command == "import":
+            try:
+                key = load_bundle_key(args.key_file)
+                if args.input == "-":
+                    result = import_store(sys.stdin.buffer, user_storage_dir, key)
+                else:
+                    with open(args.input, "rb") as f:
+                        result = import_store(f, user_storage_dir, key)
+                print(
+                    f"Imported {result['versions']} version(s) and "
+                    f"{result['legacy']} legacy file(s)."
+                )
+                logger.info(f"Store imported from {args.input} by user {username}")
+            except QuotaExceededError as e:
+                logger.error(f"Import error: {e}")
+                print(f"Import failed: {e}")
+            except Exception as e:
+                logger.error(f"Import error: {e}")
+                print("Import failed.")
+
+        elif args.command == "batch":
+            try:
+                if args.source == "-":
+                    failures = run_batch(sys.stdin, user_storage_dir, args.jobs)
+                else:
+                    with open(args.source, "r") as f:
+                        failures = run_batch(f, user_storage_dir, args.jobs)
+            except OSError as e:
+                logger.error(f"Batch error: {e}")
+                print("Batch failed.", file=sys.stderr)
+                sys.exit(1)
+            sys.exit(1 if failures else 0)
+
+        elif args.command == "shell":
+            run_shell(user_storage_dir, check_session=is_authenticated)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,219 @@
+import contextvars
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger import logger
+
+# Operation the current code runs on behalf of ("upload", "download", ...).
+# Worker threads inherit it when started through run_in_context().
+_current_op = contextvars.ContextVar("sfss_operation", default="other")
+
+
+class Metrics:
+    """Per-operation counters and phase timings, cheap enough to leave on.
+
+    Phase times are summed over threads, so for parallel transfers the
+    phases of one operation can add up to more than its wall-clock time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}  # op -> [count, errors, seconds]
+            self._phases = {}  # (op, phase) -> [count, seconds, max]
+            self._bytes = {}  # (op, kind) -> bytes
+
+    def record_operation(self, op, seconds, failed):
+        with self._lock:
+            entry = self._operations.setdefault(op, [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += failed
+            entry[2] += seconds
+
+    def record_phase(self, op, phase, seconds):
+        with self._lock:
+            entry = self._phases.setdefault((op, phase), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def add_bytes(self, op, kind, n):
+        with self._lock:
+            self._bytes[(op, kind)] = self._bytes.get((op, kind), 0) + n
+
+    def snapshot(self):
+        result = {}
+
+        def entry(op):
+            return result.setdefault(
+                op,
+                {"count": 0, "errors": 0, "seconds": 0.0, "phases": {}, "bytes": {}},
+            )
+
+        with self._lock:
+            for op, (count, errors, seconds) in self._operations.items():
+                entry(op).update(count=count, errors=errors, seconds=seconds)
+            for (op, name), (count, seconds, longest) in self._phases.items():
+                entry(op)["phases"][name] = {
+                    "count": count,
+                    "seconds": seconds,
+                    "max": longest,
+                }
+            for (op, kind), n in self._bytes.items():
+                entry(op)["bytes"][kind] = n
+        return result
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        # Each metric family is one block: its TYPE line, then all its samples
+        families = {
+            name: []
+            for name in (
+                "sfss_operations_total",
+                "sfss_operation_errors_total",
+                "sfss_operation_seconds_total",
+                "sfss_phase_seconds_total",
+                "sfss_phase_calls_total",
+                "sfss_bytes_total",
+            )
+        }
+        for op, entry in sorted(snapshot.items()):
+            label = f'op="{op}"'
+            families["sfss_operations_total"].append((label, entry["count"]))
+            families["sfss_operation_errors_total"].append((label, entry["errors"]))
+            families["sfss_operation_seconds_total"].append(
+                (label, f"{entry['seconds']:.6f}")
+            )
+            for phase, p in sorted(entry["phases"].items()):
+                labels = f'{label},phase="{phase}"'
+                families["sfss_phase_seconds_total"].append(
+                    (labels, f"{p['seconds']:.6f}")
+                )
+                families["sfss_phase_calls_total"].append((labels, p["count"]))
+            for kind, n in sorted(entry["bytes"].items()):
+                families["sfss_bytes_total"].append((f'{label},kind="{kind}"', n))
+        lines = []
+        for name, samples in families.items():
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{{{labels}}} {value}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Dump a snapshot; JSON for *.json paths, Prometheus text otherwise."""
+        data = self.to_json() if path.endswith(".json") else self.to_prometheus()
+        with open(path, "w") as f:
+            f.write(data)
+
+    def format_profile(self):
+        """Human-readable per-phase breakdown of every operation."""
+        lines = ["Phase breakdown:"]
+        for op, entry in sorted(self.snapshot().items()):
+            lines.append(
+                f"  {op}: {entry['count']} call(s), {entry['errors']} error(s), "
+                f"{entry['seconds']:.3f}s"
+            )
+            for phase, p in sorted(
+                entry["phases"].items(), key=lambda item: -item[1]["seconds"]
+            ):
+                share = p["seconds"] / entry["seconds"] * 100 if entry["seconds"] else 0
+                lines.append(
+                    f"    {phase:<14} {p['seconds']:9.3f}s {share:6.1f}%  "
+                    f"({p['count']} calls, max {p['max'] * 1000:.1f}ms)"
+                )
+            for kind, n in sorted(entry["bytes"].items()):
+                lines.append(f"    bytes {kind:<8} {n}")
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def operation(op):
+    """Time one top-level operation and count it, including failures."""
+    if _current_op.get() == op:
+        # Nested call of the same operation (upload -> upload_stream)
+        yield
+        return
+    token = _current_op.set(op)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        metrics.record_operation(op, time.perf_counter() - start, failed)
+        _current_op.reset(token)
+
+
+def timed(op):
+    """Decorator running the whole function as operation `op`."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with operation(op):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def phase(name):
+    """Time one phase (read, encrypt, storage_write, ...) of the current operation."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record_phase(_current_op.get(), name, time.perf_counter() - start)
+
+
+def add_bytes(kind, n):
+    metrics.add_bytes(_current_op.get(), kind, n)
+
+
+def run_in_context(executor, func, *args):
+    """Executor.submit that keeps the caller's current operation."""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = metrics.to_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = metrics.to_json(), "application/json"
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+
+def start_metrics_server(port, host="localhost"):
+    """Serve /metrics (Prometheus text) and /metrics.json from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="sfss-metrics", daemon=True
+    ).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,296 @@
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from config import Config
+from logger import logger
+from metrics import phase
+
+# Prefix of the temporary files LocalStorage writes before renaming into place
+TMP_PREFIX = ".sfss-tmp-"
+
+# Stored size, modification time (epoch seconds) and a tag that changes
+# whenever the object is rewritten.
+ObjectInfo = namedtuple("ObjectInfo", ["size", "modified", "etag"])
+
+
+class LocalStorage:
+    """Keeps objects as files below the user's storage directory."""
+
+    def _path(self, storage_dir, key):
+        return os.path.join(storage_dir, *key.split("/"))
+
+    def _write_tmp(self, dest_path, fileobj):
+        dest_dir = os.path.dirname(dest_path)
+        os.makedirs(dest_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                with phase("storage_write"):
+                    shutil.copyfileobj(fileobj, out, Config.IO_BUFFER_SIZE)
+                if Config.FSYNC:
+                    with phase("fsync"):
+                        out.flush()
+                        os.fsync(out.fileno())
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def write(self, storage_dir, key, fileobj):
+        dest_path = self._path(storage_dir, key)
+        # Write next to the destination and rename, so readers never see a
+        # half-written object and a failed upload keeps the previous one.
+        tmp_path = self._write_tmp(dest_path, fileobj)
+        try:
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def create(self, storage_dir, key, fileobj):
+        """Like write(), but raise FileExistsError rather than replace `key`."""
+        dest_path = self._path(storage_dir, key)
+        tmp_path = self._write_tmp(dest_path, fileobj)
+        try:
+            # Unlike rename, link fails atomically if the destination exists
+            os.link(tmp_path, dest_path)
+        finally:
+            os.remove(tmp_path)
+
+    def read(self, storage_dir, key, fileobj):
+        with phase("storage_read"), open(self._path(storage_dir, key), "rb") as src:
+            shutil.copyfileobj(src, fileobj, Config.IO_BUFFER_SIZE)
+
+    def exists(self, storage_dir, key):
+        with phase("storage_stat"):
+            return os.path.isfile(self._path(storage_dir, key))
+
+    def stat(self, storage_dir, key):
+        try:
+            with phase("storage_stat"):
+                st = os.stat(self._path(storage_dir, key))
+        except FileNotFoundError:
+            return None
+        return ObjectInfo(
+            st.st_size, st.st_mtime, f"{st.st_ino}-{st.st_mtime_ns}-{st.st_size}"
+        )
+
+    def list(self, storage_dir, prefix="", recursive=True):
+        with phase("storage_list"):
+            return self._list(storage_dir, prefix, recursive)
+
+    def _list(self, storage_dir, prefix, recursive):
+        # Only walk the sub-directory the prefix points at
+        base = prefix.rpartition("/")[0]
+        top = self._path(storage_dir, base) if base else storage_dir
+        keys = []
+        for root, dirs, files in os.walk(top):
+            rel = os.path.relpath(root, storage_dir)
+            parts = [] if rel == "." else rel.split(os.sep)
+            for f in files:
+                if f.startswith(TMP_PREFIX):
+                    continue
+                key = "/".join(parts + [f])
+                if key.startswith(prefix):
+                    keys.append(key)
+            if not recursive:
+                break
+        return sorted(keys)
+
+    def delete(self, storage_dir, key):
+        os.remove(self._path(storage_dir, key))
+
+    def rename(self, storage_dir, src, dst):
+        """Move a key, or everything below a prefix ending in "/", to `dst`."""
+        src_path = self._path(storage_dir, src.rstrip("/"))
+        dst_path = self._path(storage_dir, dst.rstrip("/"))
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        # One rename moves a whole prefix at once
+        os.replace(src_path, dst_path)
+
+    def cleanup(self, storage_dir, prefix):
+        """Remove directories left empty below `prefix`."""
+        top = self._path(storage_dir, prefix.rstrip("/"))
+        for root, dirs, files in os.walk(top, topdown=False):
+            if root != top and not os.listdir(root):
+                os.rmdir(root)
+
+
+class S3Storage:
+    """Keeps objects in an S3-compatible bucket, one key prefix per user."""
+
+    def __init__(self, bucket=None, endpoint_url=None, region=None):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config as BotoConfig
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError(
+                "The s3 storage backend requires boto3 (pip install boto3)."
+            ) from e
+
+        self.bucket = bucket or Config.S3_BUCKET
+        if not self.bucket:
+            raise ValueError("SFSS_S3_BUCKET must be set to use the s3 backend.")
+        self._client_error = ClientError
+
+        # A single client shares one pool of keep-alive connections between
+        # all transfer threads; size the pool so no thread waits for a socket.
+        self.client = boto3.session.Session().client(
+            "s3",
+            endpoint_url=endpoint_url or Config.S3_ENDPOINT_URL,
+            region_name=region or Config.S3_REGION,
+            config=BotoConfig(
+                max_pool_connections=max(
+                    Config.S3_MAX_POOL_CONNECTIONS,
+                    Config.S3_MAX_CONCURRENCY,
+                    Config.CHUNK_CONCURRENCY,
+                ),
+                retries={"max_attempts": 5, "mode": "standard"},
+            ),
+        )
+        # Objects above the threshold are uploaded as parallel multipart
+        # uploads and downloaded with parallel ranged GETs of the same size.
+        # Encrypted chunks of the default CHUNK_SIZE stay below it; only legacy
+        # objects and chunks of a larger CHUNK_SIZE are split.
+        self.transfer_config = TransferConfig(
+            multipart_threshold=Config.S3_MULTIPART_CHUNKSIZE,
+            multipart_chunksize=Config.S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=Config.S3_MAX_CONCURRENCY,
+            io_chunksize=Config.IO_BUFFER_SIZE,
+            use_threads=True,
+        )
+        logger.info(f"Using S3 storage backend (bucket {self.bucket}).")
+
+    def _prefix(self, storage_dir):
+        rel = os.path.relpath(storage_dir, Config.STORAGE_DIR)
+        if rel == "." or rel.startswith(".."):
+            rel = os.path.basename(os.path.normpath(storage_dir))
+        return rel.replace(os.sep, "/") + "/"
+
+    def _key(self, storage_dir, key):
+        return self._prefix(storage_dir) + key
+
+    def _is_missing(self, error):
+        code = error.response.get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def write(self, storage_dir, key, fileobj):
+        with phase("storage_write"):
+            self.client.upload_fileobj(
+                fileobj,
+                self.bucket,
+                self._key(storage_dir, key),
+                Config=self.transfer_config,
+            )
+
+    def create(self, storage_dir, key, fileobj):
+        """Like write(), but raise FileExistsError rather than replace `key`.
+
+        Uses a conditional PUT in a single request, so only for small objects.
+        """
+        try:
+            with phase("storage_write"):
+                self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=self._key(storage_dir, key),
+                    Body=fileobj.read(),
+                    IfNoneMatch="*",
+                )
+        except self._client_error as e:
+            code = e.response.get("Error", {}).get("Code")
+            # 409 is returned when a concurrent conditional PUT won the race
+            if code in ("PreconditionFailed", "412", "ConditionalRequestConflict"):
+                raise FileExistsError(f"{key} exists.") from e
+            raise
+
+    def read(self, storage_dir, key, fileobj):
+        try:
+            with phase("storage_read"):
+                self.client.download_fileobj(
+                    self.bucket,
+                    self._key(storage_dir, key),
+                    fileobj,
+                    Config=self.transfer_config,
+                )
+        except self._client_error as e:
+            if self._is_missing(e):
+                raise FileNotFoundError("File does not exist.") from e
+            raise
+
+    def exists(self, storage_dir, key):
+        return self.stat(storage_dir, key) is not None
+
+    def stat(self, storage_dir, key):
+        try:
+            with phase("storage_stat"):
+                head = self.client.head_object(
+                    Bucket=self.bucket, Key=self._key(storage_dir, key)
+                )
+        except self._client_error as e:
+            if self._is_missing(e):
+                return None
+            raise
+        return ObjectInfo(
+            head["ContentLength"], head["LastModified"].timestamp(), head["ETag"]
+        )
+
+    def list(self, storage_dir, prefix="", recursive=True):
+        with phase("storage_list"):
+            return self._list(storage_dir, prefix, recursive)
+
+    def _list(self, storage_dir, prefix, recursive):
+        user_prefix = self._prefix(storage_dir)
+        paginator = self.client.get_paginator("list_objects_v2")
+        options = {"Bucket": self.bucket, "Prefix": user_prefix + prefix}
+        if not recursive:
+            options["Delimiter"] = "/"
+        keys = []
+        for page in paginator.paginate(**options):
+            for obj in page.get("Contents", []):
+                keys.append(obj["Key"][len(user_prefix) :])
+        return sorted(keys)
+
+    def delete(self, storage_dir, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(storage_dir, key))
+
+    def rename(self, storage_dir, src, dst):
+        """Move a key, or everything below a prefix ending in "/", to `dst`.
+
+        S3 has no rename; keys are copied server-side and deleted one by one.
+        """
+        keys = self._list(storage_dir, src, True) if src.endswith("/") else [src]
+        for key in keys:
+            self.client.copy(
+                {"Bucket": self.bucket, "Key": self._key(storage_dir, key)},
+                self.bucket,
+                self._key(storage_dir, dst + key[len(src) :]),
+                Config=self.transfer_config,
+            )
+            self.delete(storage_dir, key)
+
+    def cleanup(self, storage_dir, prefix):
+        pass  # S3 has no directories
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if Config.STORAGE_BACKEND == "local":
+            _backend = LocalStorage()
+        elif Config.STORAGE_BACKEND == "s3":
+            _backend = S3Storage()
+        else:
+            raise ValueError(f"Unknown storage backend: {Config.STORAGE_BACKEND}")
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the process-wide backend (e.g. when embedding file_operations)."""
+    global _backend
+    _backend = backend
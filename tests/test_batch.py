@@ -0,0 +1,86 @@
+import io
+import json
+import unittest
+from unittest.mock import patch
+from batch import parse_command, run_command, run_batch
+
+
+class TestBatch(unittest.TestCase):
+    def test_parse_plain_commands(self):
+        self.assertEqual(
+            parse_command("upload 'my file.txt' --name a.txt"),
+            {"op": "upload", "file_path": "my file.txt", "name": "a.txt"},
+        )
+        self.assertEqual(
+            parse_command("download a.txt out"),
+            {"op": "download", "file_name": "a.txt", "download_dir": "out"},
+        )
+        self.assertEqual(
+            parse_command("download a.txt out --version 2"),
+            {
+                "op": "download",
+                "file_name": "a.txt",
+                "download_dir": "out",
+                "version": 2,
+            },
+        )
+        self.assertEqual(
+            parse_command("upload big.db --delta"),
+            {"op": "upload", "file_path": "big.db", "name": None, "delta": True},
+        )
+        self.assertEqual(parse_command("list"), {"op": "list"})
+        self.assertEqual(
+            parse_command("delete a.txt"), {"op": "delete", "file_name": "a.txt"}
+        )
+
+    def test_parse_json_command(self):
+        command = parse_command('{"op": "delete", "file_name": "a.txt", "id": 3}')
+        self.assertEqual(command, {"op": "delete", "file_name": "a.txt", "id": 3})
+
+    def test_parse_invalid_commands(self):
+        for line in ("bogus", "download a.txt", "upload", '{"op": "rm"}'):
+            with self.assertRaises(ValueError):
+                parse_command(line)
+
+    @patch("batch.list_files", return_value=["a.txt"])
+    def test_run_command_list(self, mock_list):
+        result = run_command({"op": "list", "id": 1}, "storage")
+        self.assertEqual(
+            result, {"op": "list", "id": 1, "files": ["a.txt"], "ok": True}
+        )
+        mock_list.assert_called_once_with("storage")
+
+    @patch("batch.delete", side_effect=FileNotFoundError("File does not exist."))
+    @patch("batch.logger.error")
+    def test_run_command_error(self, mock_logger, mock_delete):
+        result = run_command({"op": "delete", "file_name": "a.txt"}, "storage")
+        self.assertEqual(
+            result, {"op": "delete", "ok": False, "error": "File does not exist."}
+        )
+
+    @patch("batch.upload", return_value=1)
+    @patch("batch.download")
+    @patch("batch.logger")
+    def test_run_batch_keeps_input_order(self, mock_logger, mock_download, mock_upload):
+        lines = [
+            "upload a.txt\n",
+            "\n",
+            "# a comment\n",
+            '{"op": "download", "file_name": "a.txt", "download_dir": "out"}\n',
+            "bogus\n",
+        ]
+        out = io.StringIO()
+
+        failures = run_batch(lines, "storage", jobs=4, out=out)
+
+        results = [json.loads(l) for l in out.getvalue().splitlines()]
+        self.assertEqual([r.get("op") for r in results], ["upload", "download", None])
+        self.assertEqual(failures, 1)
+        mock_upload.assert_called_once_with(
+            "a.txt", "storage", file_name=None, delta=False
+        )
+        mock_download.assert_called_once_with("a.txt", "out", "storage", version=None)
+
+
+if __name__ == "__main__":
+    unittest.main()
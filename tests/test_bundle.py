@@ -0,0 +1,166 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from cryptography.fernet import Fernet
+from encryption import get_fernet, reset_fernet, decrypt_stream
+from storage import LocalStorage
+from versions import write_version, list_versions, read_manifest, read_version
+from bundle import export_bundle, import_bundle, read_index
+
+
+class TestBundle(unittest.TestCase):
+    def setUp(self):
+        self.source_dir = tempfile.mkdtemp()
+        self.target_dir = tempfile.mkdtemp()
+        self.work_dir = tempfile.mkdtemp()
+        for path in (self.source_dir, self.target_dir, self.work_dir):
+            self.addCleanup(shutil.rmtree, path)
+        self.backend = LocalStorage()
+        self.bundle_fernet = Fernet(Fernet.generate_key())
+        self.source_key = Fernet.generate_key()
+        self.use_key(self.source_key)
+        self.addCleanup(reset_fernet)
+        usage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, usage_dir)
+        usage_patch = patch("usage.Config.USAGE_DIR", usage_dir)
+        usage_patch.start()
+        self.addCleanup(usage_patch.stop)
+
+    def use_key(self, key):
+        key_patch = patch("encryption.load_key", return_value=key)
+        key_patch.start()
+        self.addCleanup(key_patch.stop)
+        reset_fernet()
+
+    def write(self, data, name):
+        write_version(io.BytesIO(data), name, self.source_dir, self.backend)
+
+    def export(self, since=None):
+        path = os.path.join(self.work_dir, f"bundle{len(os.listdir(self.work_dir))}")
+        with open(path, "wb") as f:
+            export_bundle(
+                f, self.source_dir, self.bundle_fernet, self.backend, since=since
+            )
+        return path
+
+    def import_(self, path):
+        with open(path, "rb") as f:
+            return import_bundle(f, self.target_dir, self.bundle_fernet, self.backend)
+
+    def read(self, name, version):
+        manifest = read_manifest(name, version, self.target_dir, self.backend)
+        out = io.BytesIO()
+        read_version(manifest, out, self.target_dir, self.backend)
+        return out.getvalue()
+
+    @patch("versions.Config.CHUNK_SIZE", 4)
+    def test_roundtrip_into_store_with_other_key(self):
+        self.write(b"aaaabbbb", "a")
+        self.write(b"aaaacc", "a")
+        self.backend.write(
+            self.source_dir, "old.txt", io.BytesIO(get_fernet().encrypt(b"legacy"))
+        )
+        path = self.export()
+        with open(path, "rb") as f:
+            self.assertNotIn(b"aaaa", f.read())
+
+        # Restore where the store has a different aes.key
+        self.use_key(Fernet.generate_key())
+        stats, usage = self.import_(path)
+        self.assertEqual(stats, {"chunks": 3, "versions": 2, "legacy": 1})
+        self.assertEqual(usage["objects"], 2)
+        self.assertEqual(self.read("a", 1), b"aaaabbbb")
+        self.assertEqual(self.read("a", 2), b"aaaacc")
+        stored = io.BytesIO()
+        self.backend.read(self.target_dir, "old.txt", stored)
+        stored.seek(0)
+        plain = io.BytesIO()
+        decrypt_stream(stored, plain)
+        self.assertEqual(plain.getvalue(), b"legacy")
+
+        # Importing again changes nothing
+        stats, usage = self.import_(path)
+        self.assertEqual(stats["versions"], 0)
+        self.assertEqual(usage["objects"], 0)
+
+    @patch("versions.Config.CHUNK_SIZE", 4)
+    def test_incremental_export(self):
+        self.write(b"aaaabbbb", "a")
+        full = self.export()
+        self.write(b"aaaacccc", "a")
+        self.write(b"dddd", "d")
+        incremental = self.export(since=read_index(full, self.bundle_fernet))
+
+        def chunk_ids(name, version):
+            manifest = read_manifest(name, version, self.source_dir, self.backend)
+            return {cid for cid, _ in manifest["chunks"]}
+
+        # Only the new chunks and versions; the index covers both bundles
+        index = read_index(incremental, self.bundle_fernet)
+        new_chunks = (chunk_ids("a", 2) | chunk_ids("d", 1)) - chunk_ids("a", 1)
+        self.assertEqual(
+            {e[1] for e in index["entries"] if e[0] == "chunk"}, new_chunks
+        )
+        self.assertEqual(
+            [e[:3] for e in index["entries"] if e[0] == "manifest"],
+            [["manifest", "a", 2], ["manifest", "d", 1]],
+        )
+        self.assertEqual(len(index["versions"]), 3)
+
+        self.use_key(Fernet.generate_key())
+        with self.assertRaises(ValueError):
+            self.import_(incremental)  # Its base is missing
+        self.import_(full)
+        self.import_(incremental)
+        self.assertEqual(list_versions("a", self.target_dir, self.backend), [1, 2])
+        self.assertEqual(self.read("a", 2), b"aaaacccc")
+        self.assertEqual(self.read("d", 1), b"dddd")
+
+    def test_incremental_export_of_reused_version_number(self):
+        self.write(b"OLD", "db")
+        full = self.export()
+        # db is deleted and purged, so new content is stored as version 1 again
+        shutil.rmtree(os.path.join(self.source_dir, ".sfss", "versions", "db"))
+        self.write(b"NEW", "db")
+        incremental = self.export(since=read_index(full, self.bundle_fernet))
+        index = read_index(incremental, self.bundle_fernet)
+        self.assertEqual(
+            [e[:3] for e in index["entries"] if e[0] == "manifest"],
+            [["manifest", "db", 1]],
+        )
+
+        self.import_(full)
+        stats, _ = self.import_(incremental)
+        self.assertEqual(stats["versions"], 1)
+        self.assertEqual(list_versions("db", self.target_dir, self.backend), [1, 2])
+        self.assertEqual(self.read("db", 1), b"OLD")
+        self.assertEqual(self.read("db", 2), b"NEW")
+
+        # Importing again finds the renumbered version
+        stats, _ = self.import_(incremental)
+        self.assertEqual(stats["versions"], 0)
+
+    def test_wrong_key_and_truncated_bundle(self):
+        self.write(b"data", "a")
+        path = self.export()
+        with self.assertRaises(Exception):
+            with open(path, "rb") as f:
+                import_bundle(
+                    f, self.target_dir, Fernet(Fernet.generate_key()), self.backend
+                )
+        with open(path, "rb") as f:
+            data = f.read()
+        with self.assertRaises(ValueError):
+            import_bundle(
+                io.BytesIO(data[:-20]),
+                self.target_dir,
+                self.bundle_fernet,
+                self.backend,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from cache import ObjectCache
+
+
+class TestObjectCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = ObjectCache(100)
+        self.assertIsNone(cache.get(("s", "a", "1")))
+        cache.put(("s", "a", "1"), b"data")
+        self.assertEqual(cache.get(("s", "a", "1")), b"data")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["bytes"], 4)
+
+    def test_evicts_least_recently_used(self):
+        cache = ObjectCache(10)
+        cache.put(("s", "a", "1"), b"aaaa")
+        cache.put(("s", "b", "1"), b"bbbb")
+        cache.get(("s", "a", "1"))
+        cache.put(("s", "c", "1"), b"cccc")
+
+        self.assertIsNone(cache.get(("s", "b", "1")))
+        self.assertEqual(cache.get(("s", "a", "1")), b"aaaa")
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["bytes"], 8)
+
+    def test_oversized_objects_are_not_cached(self):
+        cache = ObjectCache(4)
+        cache.put(("s", "a", "1"), b"too large")
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_invalidate_all_versions(self):
+        cache = ObjectCache(100)
+        cache.put(("s", "a", "1"), b"one")
+        cache.put(("s", "a", "2"), b"two")
+        cache.put(("s", "b", "1"), b"other")
+        cache.invalidate("s", "a")
+        self.assertEqual(cache.stats()["entries"], 1)
+        self.assertEqual(cache.stats()["bytes"], 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
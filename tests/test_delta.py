@@ -0,0 +1,68 @@
+import io
+import os
+import unittest
+import zlib
+from unittest.mock import patch
+from cryptography.fernet import Fernet
+from delta import signatures, delta_chunks
+from encryption import chunk_id, reset_fernet
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        key_patch = patch("encryption.load_key", return_value=Fernet.generate_key())
+        key_patch.start()
+        self.addCleanup(key_patch.stop)
+        reset_fernet()
+        self.addCleanup(reset_fernet)
+
+    def known(self, data, block_size):
+        blocks = [data[i : i + block_size] for i in range(0, len(data), block_size)]
+        manifest = {
+            "chunks": [[chunk_id(b), len(b)] for b in blocks],
+            "weak": [zlib.adler32(b) for b in blocks],
+        }
+        return signatures(manifest, block_size)
+
+    def test_in_place_edits_reuse_the_following_blocks(self):
+        old = os.urandom(96)
+        new = old[:20] + b"edit" + old[24:70] + b"!" + old[71:]
+        pieces = list(delta_chunks(io.BytesIO(new), self.known(old, 16), 16))
+
+        # Only the two edited blocks are new, found without searching
+        self.assertEqual(
+            [p for p in pieces if isinstance(p, bytes)], [new[16:32], new[64:80]]
+        )
+        self.assertEqual(
+            [p[0] for p in pieces if isinstance(p, list)],
+            [chunk_id(old[i : i + 16]) for i in (0, 32, 48, 80)],
+        )
+
+    def test_signatures_skip_short_blocks_and_old_manifests(self):
+        known = self.known(b"aaaabbbbcc", 4)
+        self.assertEqual(sum(len(cids) for cids in known.values()), 2)
+        self.assertIsNone(signatures({"chunks": []}, 4))
+
+    def test_insertion_only_sends_new_data(self):
+        old = os.urandom(64)
+        new = old[:16] + b"inserted" + old[16:]
+        pieces = list(delta_chunks(io.BytesIO(new), self.known(old, 16), 16))
+
+        literals = [p for p in pieces if isinstance(p, bytes)]
+        matched = [p for p in pieces if isinstance(p, list)]
+        self.assertEqual(literals, [b"inserted"])
+        self.assertEqual(len(matched), 4)
+        self.assertEqual(
+            [cid for cid, _, _ in matched],
+            [chunk_id(old[i : i + 16]) for i in range(0, 64, 16)],
+        )
+
+    def test_unrelated_data_is_split_into_blocks(self):
+        new = os.urandom(40)
+        pieces = list(delta_chunks(io.BytesIO(new), self.known(os.urandom(32), 16), 16))
+        self.assertEqual([len(p) for p in pieces], [16, 16, 8])
+        self.assertEqual(b"".join(pieces), new)
+
+
+if __name__ == "__main__":
+    unittest.main()
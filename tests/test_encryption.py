@@ -1,7 +1,16 @@
 import unittest
 from unittest.mock import patch, mock_open, MagicMock
+import io
 import os
-from encryption import generate_key, load_key, encrypt_file, decrypt_file
+from encryption import (
+    generate_key,
+    load_key,
+    encrypt_file,
+    decrypt_file,
+    EncryptingReader,
+    decrypt_stream,
+    STREAM_MAGIC,
+)
 from cryptography.fernet import Fernet
 from config import Config
 
@@ -88,3 +97,54 @@ class TestEncryptionFunctions(unittest.TestCase):
         fernet = Fernet(key)
 
         # Prepare encrypted data to simulate a file
+
+
+class TestStreamEncryption(unittest.TestCase):
+    def setUp(self):
+        self.fernet = Fernet(Fernet.generate_key())
+
+    def roundtrip(self, data, chunk_size=4):
+        encrypted = EncryptingReader(io.BytesIO(data), self.fernet, chunk_size).read()
+        out = io.BytesIO()
+        decrypt_stream(io.BytesIO(encrypted), out, self.fernet)
+        return encrypted, out.getvalue()
+
+    def test_roundtrip(self):
+        for data in (b"", b"abc", b"abcd", b"abcdefghij"):
+            encrypted, decrypted = self.roundtrip(data)
+            self.assertTrue(encrypted.startswith(STREAM_MAGIC))
+            self.assertEqual(decrypted, data)
+
+    def test_short_reads_from_pipe(self):
+        class Trickle(io.RawIOBase):
+            def __init__(self, data):
+                self.data = data
+
+            def read(self, n=-1):
+                chunk, self.data = self.data[:1], self.data[1:]
+                return chunk
+
+        encrypted = EncryptingReader(Trickle(b"abcdefghij"), self.fernet, 4).read()
+        out = io.BytesIO()
+        decrypt_stream(io.BytesIO(encrypted), out, self.fernet)
+        self.assertEqual(out.getvalue(), b"abcdefghij")
+
+    def test_truncated_stream(self):
+        encrypted, _ = self.roundtrip(b"abcdefghij")
+        # Cut after the first frame
+        first_frame_end = (
+            len(STREAM_MAGIC)
+            + 4
+            + int.from_bytes(
+                encrypted[len(STREAM_MAGIC) : len(STREAM_MAGIC) + 4], "big"
+            )
+        )
+        with self.assertRaises(ValueError):
+            decrypt_stream(
+                io.BytesIO(encrypted[:first_frame_end]), io.BytesIO(), self.fernet
+            )
+
+    def test_legacy_single_token(self):
+        out = io.BytesIO()
+        decrypt_stream(io.BytesIO(self.fernet.encrypt(b"old data")), out, self.fernet)
+        self.assertEqual(out.getvalue(), b"old data")
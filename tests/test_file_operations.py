@@ -1,149 +1,373 @@
 import unittest
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, MagicMock
+import io
 import os
-from file_operations import upload, download, list_files, delete, sanitize_path
-from encryption import encrypt_file, decrypt_file
-from logger import logger
+import shutil
+import tempfile
+from cryptography.fernet import Fernet
+import file_operations
+from file_operations import (
+    upload,
+    upload_stream,
+    download,
+    download_stream,
+    list_files,
+    list_file_versions,
+    delete,
+    delete_matching,
+    undelete,
+    list_deleted,
+    prune,
+    usage_report,
+    reconcile_usage,
+    export_store,
+    import_store,
+    sanitize_path,
+    enable_cache,
+    disable_cache,
+)
+from encryption import get_fernet, reset_fernet
+from storage import LocalStorage
+from usage import QuotaExceededError
+from versions import write_version
 
 
 class TestFileOperations(unittest.TestCase):
+    def setUp(self):
+        # Real local storage in a temp dir, with a throwaway encryption key
+        self.storage_dir = tempfile.mkdtemp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_dir)
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.backend = LocalStorage()
+        key_patch = patch("encryption.load_key", return_value=Fernet.generate_key())
+        key_patch.start()
+        self.addCleanup(key_patch.stop)
+        reset_fernet()
+        self.addCleanup(reset_fernet)
+        usage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, usage_dir)
+        usage_patch = patch("usage.Config.USAGE_DIR", usage_dir)
+        usage_patch.start()
+        self.addCleanup(usage_patch.stop)
+
+    def make_file(self, name, data):
+        path = os.path.join(self.work_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def upload_bytes(self, data, name):
+        return upload_stream(io.BytesIO(data), name, self.storage_dir, self.backend)
+
+    def download_bytes(self, name, version=None):
+        out = io.BytesIO()
+        download_stream(name, out, self.storage_dir, self.backend, version=version)
+        return out.getvalue()
 
-    @patch("file_operations.os.path.isfile", return_value=True)
-    @patch("file_operations.os.makedirs")
-    @patch("file_operations.shutil.copy")
-    @patch("file_operations.encrypt_file")
     @patch("file_operations.logger.info")
-    def test_upload_success(
-        self, mock_logger, mock_encrypt, mock_copy, mock_makedirs, mock_isfile
-    ):
-        file_path = "test.txt"
-        storage_dir = "storage"
+    def test_upload_download_roundtrip(self, mock_logger):
+        path = self.make_file("test.txt", b"some data")
 
-        # Simulate a successful upload
-        upload(file_path, storage_dir)
+        version = upload(path, self.storage_dir, backend=self.backend)
+        self.assertEqual(version, 1)
+        mock_logger.assert_any_call("File uploaded: test.txt")
 
-        # Verify the file existence check and directory creation
-        mock_isfile.assert_called_once_with(file_path)
-        mock_makedirs.assert_called_once_with(storage_dir, exist_ok=True)
+        download_dir = os.path.join(self.work_dir, "downloads")
+        download("test.txt", download_dir, self.storage_dir, backend=self.backend)
+        self.assertEqual(os.listdir(download_dir), ["test.txt"])
+        with open(os.path.join(download_dir, "test.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"some data")
+        mock_logger.assert_any_call(f"File downloaded: test.txt to {download_dir}")
 
-        # Verify file copy and encryption
-        mock_copy.assert_called_once_with(
-            file_path, os.path.join(storage_dir, "test.txt")
-        )
-        mock_encrypt.assert_called_once_with(os.path.join(storage_dir, "test.txt"))
-        mock_logger.assert_called_once_with("File uploaded: test.txt")
+    def test_stored_data_is_encrypted(self):
+        self.upload_bytes(b"secret" * 100, "a.txt")
+        for key in self.backend.list(self.storage_dir):
+            out = io.BytesIO()
+            self.backend.read(self.storage_dir, key, out)
+            self.assertNotIn(b"secret", out.getvalue())
+
+    @patch("file_operations.logger.info")
+    def test_upload_stream_with_name(self, mock_logger):
+        self.upload_bytes(b"from stdin", "dump.sql")
+        self.assertEqual(self.download_bytes("dump.sql"), b"from stdin")
+        mock_logger.assert_any_call("File uploaded: dump.sql")
+
+    def test_upload_stream_invalid_name(self):
+        for name in ("../x", "a/b", ".sfss", ""):
+            with self.assertRaises(ValueError):
+                upload_stream(io.BytesIO(b""), name, "storage", backend=MagicMock())
 
     @patch("file_operations.os.path.isfile", return_value=False)
     @patch("file_operations.logger.error")
     def test_upload_file_not_found(self, mock_logger, mock_isfile):
         file_path = "nonexistent.txt"
         storage_dir = "storage"
+        backend = MagicMock()
 
         # Simulate file not found
         with self.assertRaises(FileNotFoundError):
-            upload(file_path, storage_dir)
+            upload(file_path, storage_dir, backend=backend)
 
         # Verify error logging
         mock_isfile.assert_called_once_with(file_path)
         mock_logger.assert_called_once_with("Upload failed: File does not exist.")
+        backend.write.assert_not_called()
 
-    @patch("file_operations.decrypt_file")
-    @patch("file_operations.encrypt_file")
-    @patch(
-        "file_operations.os.path.exists",
-        side_effect=lambda x: x == os.path.join("storage", "test.txt"),
-    )
-    @patch("file_operations.os.makedirs")
-    @patch("file_operations.shutil.copy")
-    @patch("file_operations.logger.info")
-    def test_download_success(
-        self,
-        mock_logger,
-        mock_copy,
-        mock_makedirs,
-        mock_exists,
-        mock_encrypt,
-        mock_decrypt,
-    ):
-        file_name = "test.txt"
-        storage_dir = "storage"
-        download_dir = "downloads"
+    @patch("file_operations.logger.error")
+    def test_download_file_not_found(self, mock_logger):
+        download_dir = os.path.join(self.work_dir, "downloads")
 
-        # Simulate a successful download
-        download(file_name, download_dir, storage_dir)
+        # Simulate file not found
+        with self.assertRaises(FileNotFoundError):
+            download("nonexistent.txt", download_dir, self.storage_dir, self.backend)
 
-        # Verify decrypt and re-encrypt process
-        mock_decrypt.assert_called_once_with(os.path.join(storage_dir, file_name))
-        mock_encrypt.assert_called_once_with(os.path.join(storage_dir, file_name))
+        # Verify error logging and that no partial download is left behind
+        mock_logger.assert_called_once_with("Download failed: File does not exist.")
+        self.assertEqual(os.listdir(download_dir), [])
 
-        # Ensure `os.makedirs` is called since `mock_exists` should return `False` for the download directory
-        mock_makedirs.assert_any_call(download_dir, exist_ok=True)
+    @patch("versions.Config.CHUNK_SIZE", 4)
+    def test_versions_share_unchanged_chunks(self):
+        self.upload_bytes(b"aaaabbbbcccc", "f")
+        self.upload_bytes(b"aaaaXXXXcccc", "f")
 
-        # Verify file copy
-        mock_copy.assert_called_once_with(
-            os.path.join(storage_dir, file_name), os.path.join(download_dir, file_name)
-        )
-        mock_logger.assert_called_once_with(
-            f"File downloaded: {file_name} to {download_dir}"
-        )
+        # Three chunks for the first version, one new chunk for the second
+        chunks = self.backend.list(self.storage_dir, ".sfss/chunks/")
+        self.assertEqual(len(chunks), 4)
 
-    @patch("file_operations.os.path.exists", return_value=False)
-    @patch("file_operations.logger.error")
-    def test_download_file_not_found(self, mock_logger, mock_exists):
-        file_name = "nonexistent.txt"
-        storage_dir = "storage"
-        download_dir = "downloads"
+        versions = list_file_versions("f", self.storage_dir, self.backend)
+        self.assertEqual([v["version"] for v in versions], [1, 2])
+        self.assertEqual([v["size"] for v in versions], [12, 12])
 
-        # Simulate file not found
+        self.assertEqual(self.download_bytes("f", 1), b"aaaabbbbcccc")
+        self.assertEqual(self.download_bytes("f", 2), b"aaaaXXXXcccc")
+        self.assertEqual(self.download_bytes("f"), b"aaaaXXXXcccc")
         with self.assertRaises(FileNotFoundError):
-            download(file_name, download_dir, storage_dir)
+            self.download_bytes("f", 7)
 
-        # Verify error logging
-        mock_logger.assert_called_once_with("Download failed: File does not exist.")
+    @patch("versions.Config.DELTA_BLOCK_SIZE", 8)
+    def test_delta_upload_stores_only_changed_blocks(self):
+        old = os.urandom(64)
+        upload_stream(
+            io.BytesIO(old), "big.db", self.storage_dir, self.backend, delta=True
+        )
+        new = b"prefix" + old[:40] + b"changed!" + old[48:]
+        with patch.object(self.backend, "write", wraps=self.backend.write) as write:
+            upload_stream(
+                io.BytesIO(new), "big.db", self.storage_dir, self.backend, delta=True
+            )
+        # Only "prefix" and "changed!"; shifted blocks are reused
+        self.assertEqual(write.call_count, 2)
+        self.assertEqual(self.download_bytes("big.db"), new)
+        self.assertEqual(self.download_bytes("big.db", 1), old)
+
+    def test_legacy_object_is_version_zero(self):
+        # Objects stored before versioning are a single Fernet token at <name>
+        self.backend.write(
+            self.storage_dir, "old.txt", io.BytesIO(get_fernet().encrypt(b"old"))
+        )
+        self.upload_bytes(b"new", "old.txt")
+
+        self.assertEqual(list_files(self.storage_dir, self.backend), ["old.txt"])
+        versions = list_file_versions("old.txt", self.storage_dir, self.backend)
+        self.assertEqual([v["version"] for v in versions], [0, 1])
+        self.assertEqual(self.download_bytes("old.txt", 0), b"old")
+        self.assertEqual(self.download_bytes("old.txt"), b"new")
 
-    @patch("file_operations.os.listdir", return_value=["file1.txt", "file2.txt"])
-    @patch("file_operations.os.path.isfile", side_effect=lambda x: True)
-    @patch("file_operations.os.makedirs")
     @patch("file_operations.logger.info")
-    def test_list_files(self, mock_logger, mock_makedirs, mock_isfile, mock_listdir):
-        storage_dir = "storage"
+    def test_list_files(self, mock_logger):
+        self.upload_bytes(b"1", "file1.txt")
+        self.upload_bytes(b"2", "file2.txt")
 
         # Simulate listing files
-        files = list_files(storage_dir)
+        files = list_files(self.storage_dir, backend=self.backend)
 
-        # Verify the list of files
+        # Verify the list of files, without internal data
         self.assertEqual(files, ["file1.txt", "file2.txt"])
-        mock_logger.assert_called_once_with("Listed files.")
-        mock_makedirs.assert_called_once_with(storage_dir, exist_ok=True)
+        mock_logger.assert_called_with("Listed files.")
 
-    @patch("file_operations.os.path.exists", return_value=True)
-    @patch("file_operations.os.remove")
     @patch("file_operations.logger.info")
-    def test_delete_success(self, mock_logger, mock_remove, mock_exists):
-        file_name = "test.txt"
-        storage_dir = "storage"
+    def test_delete_success(self, mock_logger):
+        self.upload_bytes(b"1", "test.txt")
+        self.upload_bytes(b"2", "test.txt")
 
         # Simulate successful deletion
-        delete(file_name, storage_dir)
+        delete("test.txt", self.storage_dir, backend=self.backend)
 
-        # Verify file removal
-        mock_exists.assert_called_once_with(os.path.join(storage_dir, file_name))
-        mock_remove.assert_called_once_with(os.path.join(storage_dir, file_name))
-        mock_logger.assert_called_once_with(f"File deleted: {file_name}")
+        # Every version is gone
+        self.assertEqual(list_files(self.storage_dir, self.backend), [])
+        mock_logger.assert_any_call("File deleted: test.txt")
 
-    @patch("file_operations.os.path.exists", return_value=False)
     @patch("file_operations.logger.error")
-    def test_delete_file_not_found(self, mock_logger, mock_exists):
-        file_name = "nonexistent.txt"
-        storage_dir = "storage"
-
+    def test_delete_file_not_found(self, mock_logger):
         # Simulate file not found
         with self.assertRaises(FileNotFoundError):
-            delete(file_name, storage_dir)
+            delete("nonexistent.txt", self.storage_dir, backend=self.backend)
 
         # Verify error logging
         mock_logger.assert_called_once_with("Delete failed: File does not exist.")
 
+    def test_delete_matching_and_undelete(self):
+        for name in ("a.log", "b.log", "keep.txt", "tmp-1"):
+            self.upload_bytes(b"x", name)
+
+        with patch(
+            "file_operations.update_usage", wraps=file_operations.update_usage
+        ) as update:
+            deleted = delete_matching(
+                ["*.log"], self.storage_dir, self.backend, prefix="tmp-"
+            )
+        # The counters are updated once for the whole batch
+        self.assertEqual(update.call_count, 1)
+        self.assertEqual(deleted, ["a.log", "b.log", "tmp-1"])
+        self.assertEqual(list_files(self.storage_dir, self.backend), ["keep.txt"])
+        self.assertEqual(
+            [e["name"] for e in list_deleted(self.storage_dir, self.backend)],
+            ["a.log", "b.log", "tmp-1"],
+        )
+        self.assertEqual(usage_report(self.storage_dir)["objects"], 1)
+
+        # Only the files last uploaded long enough ago
+        self.assertEqual(
+            delete_matching(["*"], self.storage_dir, self.backend, older_than=3600),
+            [],
+        )
+
+        self.assertEqual(
+            undelete(["*.log"], self.storage_dir, self.backend), ["a.log", "b.log"]
+        )
+        self.assertEqual(self.download_bytes("a.log"), b"x")
+        self.assertEqual(usage_report(self.storage_dir)["objects"], 3)
+        with self.assertRaises(FileNotFoundError):
+            undelete(["nothing*"], self.storage_dir, self.backend)
+
+        # A file that exists again cannot be overwritten by its deleted copy
+        self.upload_bytes(b"new", "tmp-1")
+        with self.assertRaises(FileExistsError):
+            undelete(["tmp-1"], self.storage_dir, self.backend)
+
+    def test_exact_names_are_not_globs(self):
+        self.upload_bytes(b"bracketed", "report[1].txt")
+        self.upload_bytes(b"plain", "report1.txt")
+        self.assertEqual(
+            delete_matching(["report[1].txt"], self.storage_dir, self.backend),
+            ["report[1].txt"],
+        )
+        self.assertEqual(list_files(self.storage_dir, self.backend), ["report1.txt"])
+
+        # Without a file of that name the pattern is a glob again
+        delete_matching(["report[1].txt"], self.storage_dir, self.backend)
+        self.assertEqual(list_files(self.storage_dir, self.backend), [])
+
+        self.assertEqual(
+            undelete(["report[1].txt"], self.storage_dir, self.backend),
+            ["report[1].txt"],
+        )
+        self.assertEqual(self.download_bytes("report[1].txt"), b"bracketed")
+        self.assertEqual(list_files(self.storage_dir, self.backend), ["report[1].txt"])
+
+    def test_download_cache(self):
+        cache = enable_cache(1024)
+        self.addCleanup(disable_cache)
+        self.upload_bytes(b"hot config", "hot.cfg")
+
+        # First download misses and fills the cache, the second is a hit
+        with patch.object(self.backend, "read", wraps=self.backend.read) as read:
+            self.assertEqual(self.download_bytes("hot.cfg"), b"hot config")
+            self.assertEqual(self.download_bytes("hot.cfg"), b"hot config")
+            # One read for the manifest and one for the single chunk
+            self.assertEqual(read.call_count, 2)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+        # A new upload invalidates the cached copy
+        self.upload_bytes(b"new config", "hot.cfg")
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertEqual(self.download_bytes("hot.cfg"), b"new config")
+
+        # Deleting invalidates every cached copy of the object
+        delete("hot.cfg", self.storage_dir, backend=self.backend)
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_download_cache_sees_content_rewritten_elsewhere(self):
+        enable_cache(1024)
+        self.addCleanup(disable_cache)
+        self.upload_bytes(b"old", "cfg")
+        self.assertEqual(self.download_bytes("cfg", 1), b"old")
+
+        # Another process deletes and purges cfg, then stores new content as
+        # version 1 again, without touching this process's cache
+        shutil.rmtree(os.path.join(self.storage_dir, ".sfss", "versions", "cfg"))
+        write_version(io.BytesIO(b"new"), "cfg", self.storage_dir, self.backend)
+        self.assertEqual(self.download_bytes("cfg", 1), b"new")
+
+    def stored_bytes(self):
+        return sum(
+            self.backend.stat(self.storage_dir, key).size
+            for key in self.backend.list(self.storage_dir)
+        )
+
+    @patch("versions.Config.CHUNK_SIZE", 4)
+    def test_usage_tracks_uploads_and_deletes(self):
+        self.upload_bytes(b"aaaabbbb", "a")
+        self.upload_bytes(b"aaaacccc", "a")
+        self.upload_bytes(b"xy", "b")
+
+        usage = usage_report(self.storage_dir)
+        self.assertEqual(usage["objects"], 2)
+        self.assertEqual(usage["logical_bytes"], 18)
+        self.assertEqual(usage["stored_bytes"], self.stored_bytes())
+        self.assertEqual(usage["quota"], 0)
+
+        delete("b", self.storage_dir, backend=self.backend)
+        with patch("versions.Config.KEEP_VERSIONS", 1), patch(
+            "versions.Config.GC_GRACE_SECONDS", -1
+        ), patch("versions.Config.TRASH_GRACE_SECONDS", -1):
+            prune(self.storage_dir, backend=self.backend)
+        usage = usage_report(self.storage_dir)
+        self.assertEqual(usage["objects"], 1)
+        self.assertEqual(usage["logical_bytes"], 8)
+        self.assertEqual(usage["stored_bytes"], self.stored_bytes())
+
+        # Nothing to repair when the counters are right
+        result = reconcile_usage(self.storage_dir, backend=self.backend)
+        for counter in ("objects", "logical_bytes", "stored_bytes"):
+            self.assertEqual(result["before"][counter], result["after"][counter])
+
+    @patch("usage.Config.DEFAULT_QUOTA_BYTES", 10)
+    def test_quota_checked_before_writing(self):
+        path = self.make_file("big.bin", b"x" * 11)
+        with self.assertRaises(QuotaExceededError):
+            upload(path, self.storage_dir, backend=self.backend)
+        self.assertEqual(self.backend.list(self.storage_dir), [])
+
+        self.upload_bytes(b"x" * 6, "a")
+        # Streams of unknown size are checked chunk by chunk
+        with patch("versions.Config.CHUNK_SIZE", 2):
+            with self.assertRaises(QuotaExceededError):
+                self.upload_bytes(b"y" * 6, "b")
+        self.assertEqual(list_files(self.storage_dir, self.backend), ["a"])
+        self.assertEqual(usage_report(self.storage_dir)["logical_bytes"], 6)
+
+    def test_import_checks_quota_before_writing(self):
+        self.upload_bytes(b"x" * 8, "a")
+        key = Fernet.generate_key()
+        bundle = io.BytesIO()
+        export_store(bundle, self.storage_dir, key, backend=self.backend)
+
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        bundle.seek(0)
+        with patch("usage.Config.DEFAULT_QUOTA_BYTES", 5):
+            with self.assertRaises(QuotaExceededError):
+                import_store(bundle, target_dir, key, backend=self.backend)
+        self.assertEqual(self.backend.list(target_dir), [])
+        self.assertEqual(usage_report(target_dir)["logical_bytes"], 0)
+
+        bundle.seek(0)
+        import_store(bundle, target_dir, key, backend=self.backend)
+        self.assertEqual(usage_report(target_dir)["logical_bytes"], 8)
+
     def test_sanitize_path_valid(self):
         sanitized = sanitize_path("file.txt", "storage")
         self.assertEqual(sanitized, os.path.join("storage", "file.txt"))
@@ -0,0 +1,99 @@
+import json
+import unittest
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from metrics import (
+    Metrics,
+    metrics,
+    operation,
+    phase,
+    timed,
+    add_bytes,
+    run_in_context,
+    start_metrics_server,
+)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_operation_phases_and_bytes(self):
+        with operation("upload"):
+            with phase("encrypt"):
+                pass
+            with phase("encrypt"):
+                pass
+            add_bytes("plaintext", 10)
+
+        snapshot = metrics.snapshot()["upload"]
+        self.assertEqual(snapshot["count"], 1)
+        self.assertEqual(snapshot["errors"], 0)
+        self.assertEqual(snapshot["phases"]["encrypt"]["count"], 2)
+        self.assertEqual(snapshot["bytes"], {"plaintext": 10})
+
+    def test_errors_are_counted(self):
+        with self.assertRaises(ValueError):
+            with operation("delete"):
+                raise ValueError("boom")
+        self.assertEqual(metrics.snapshot()["delete"]["errors"], 1)
+
+    def test_nested_same_operation_counts_once(self):
+        @timed("upload")
+        def inner():
+            pass
+
+        @timed("upload")
+        def outer():
+            inner()
+
+        outer()
+        self.assertEqual(metrics.snapshot()["upload"]["count"], 1)
+
+    def test_worker_threads_keep_operation(self):
+        def work():
+            with phase("storage_write"):
+                pass
+
+        with operation("upload"), ThreadPoolExecutor(2) as executor:
+            run_in_context(executor, work).result()
+        self.assertIn("storage_write", metrics.snapshot()["upload"]["phases"])
+
+    def test_prometheus_format(self):
+        m = Metrics()
+        m.record_operation("download", 0.5, False)
+        m.record_phase("download", "decrypt", 0.25)
+        m.add_bytes("download", "plaintext", 42)
+        text = m.to_prometheus()
+        self.assertIn('sfss_operations_total{op="download"} 1', text)
+        self.assertIn(
+            'sfss_phase_seconds_total{op="download",phase="decrypt"} 0.250000', text
+        )
+        self.assertIn('sfss_bytes_total{op="download",kind="plaintext"} 42', text)
+
+        # Every family is one contiguous block headed by its TYPE line
+        m.record_operation("upload", 0.1, True)
+        families = []
+        for line in m.to_prometheus().splitlines():
+            if line.startswith("# TYPE "):
+                families.append(line.split()[2])
+            else:
+                self.assertEqual(line.split("{")[0], families[-1])
+        self.assertEqual(len(families), len(set(families)))
+
+    def test_metrics_server(self):
+        with operation("list"):
+            pass
+        server = start_metrics_server(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://localhost:{port}/metrics.json") as r:
+            self.assertEqual(json.loads(r.read())["list"]["count"], 1)
+        with urllib.request.urlopen(f"http://localhost:{port}/metrics") as r:
+            self.assertIn(b'sfss_operations_total{op="list"} 1', r.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from storage import LocalStorage, S3Storage, get_backend, set_backend
+from config import Config
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:  # The s3 tests need boto3 and moto
+    boto3 = None
+
+
+class TestLocalStorage(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        self.backend = LocalStorage()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_dir)
+
+    def test_write_read_roundtrip(self):
+        self.backend.write(self.storage_dir, "a.txt", io.BytesIO(b"hello"))
+        out = io.BytesIO()
+        self.backend.read(self.storage_dir, "a.txt", out)
+        self.assertEqual(out.getvalue(), b"hello")
+        self.assertTrue(self.backend.exists(self.storage_dir, "a.txt"))
+
+    def test_failed_write_keeps_previous_object(self):
+        self.backend.write(self.storage_dir, "a.txt", io.BytesIO(b"old"))
+
+        class Broken(io.RawIOBase):
+            def readinto(self, b):
+                raise IOError("source went away")
+
+        with self.assertRaises(IOError):
+            self.backend.write(self.storage_dir, "a.txt", Broken())
+        out = io.BytesIO()
+        self.backend.read(self.storage_dir, "a.txt", out)
+        self.assertEqual(out.getvalue(), b"old")
+        self.assertEqual(os.listdir(self.storage_dir), ["a.txt"])
+
+    def test_list_and_delete(self):
+        self.backend.write(self.storage_dir, "a.txt", io.BytesIO(b"1"))
+        self.backend.write(self.storage_dir, "sub/b.txt", io.BytesIO(b"2"))
+        self.assertEqual(self.backend.list(self.storage_dir), ["a.txt", "sub/b.txt"])
+        self.assertEqual(self.backend.list(self.storage_dir, "sub/"), ["sub/b.txt"])
+
+        self.backend.delete(self.storage_dir, "a.txt")
+        self.assertFalse(self.backend.exists(self.storage_dir, "a.txt"))
+
+    def test_create_never_replaces(self):
+        self.backend.create(self.storage_dir, "v/a/1", io.BytesIO(b"first"))
+        with self.assertRaises(FileExistsError):
+            self.backend.create(self.storage_dir, "v/a/1", io.BytesIO(b"second"))
+        out = io.BytesIO()
+        self.backend.read(self.storage_dir, "v/a/1", out)
+        self.assertEqual(out.getvalue(), b"first")
+        self.assertEqual(self.backend.list(self.storage_dir), ["v/a/1"])
+
+    def test_rename_prefix_and_cleanup(self):
+        self.backend.write(self.storage_dir, "v/a/1", io.BytesIO(b"1"))
+        self.backend.write(self.storage_dir, "v/a/2", io.BytesIO(b"2"))
+        self.backend.rename(self.storage_dir, "v/a/", "trash/x/a/")
+        self.assertEqual(
+            self.backend.list(self.storage_dir), ["trash/x/a/1", "trash/x/a/2"]
+        )
+
+        for key in self.backend.list(self.storage_dir, "trash/"):
+            self.backend.delete(self.storage_dir, key)
+        self.backend.cleanup(self.storage_dir, "trash/")
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, "trash")), [])
+
+
+@unittest.skipIf(boto3 is None, "boto3 and moto are required for the s3 tests")
+class TestS3Storage(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="sfss-test")
+        self.backend = S3Storage(bucket="sfss-test", region="us-east-1")
+        self.storage_dir = os.path.join(Config.STORAGE_DIR, "testuser")
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_keys_are_prefixed_per_user(self):
+        self.backend.write(self.storage_dir, "a.txt", io.BytesIO(b"hello"))
+        keys = [
+            o["Key"]
+            for o in self.backend.client.list_objects_v2(Bucket="sfss-test")["Contents"]
+        ]
+        self.assertEqual(keys, ["testuser/a.txt"])
+        self.assertEqual(self.backend.list(self.storage_dir), ["a.txt"])
+
+    @patch.object(Config, "S3_MULTIPART_CHUNKSIZE", 5 * 1024 * 1024)
+    def test_multipart_roundtrip(self):
+        backend = S3Storage(bucket="sfss-test", region="us-east-1")
+        data = os.urandom(12 * 1024 * 1024)
+        backend.write(self.storage_dir, "big.bin", io.BytesIO(data))
+
+        head = backend.client.head_object(Bucket="sfss-test", Key="testuser/big.bin")
+        self.assertTrue(head["ETag"].strip('"').endswith("-3"))  # Three parts
+
+        out = io.BytesIO()
+        backend.read(self.storage_dir, "big.bin", out)
+        self.assertEqual(out.getvalue(), data)
+
+    def test_missing_object(self):
+        self.assertFalse(self.backend.exists(self.storage_dir, "missing.txt"))
+        with self.assertRaises(FileNotFoundError):
+            self.backend.read(self.storage_dir, "missing.txt", io.BytesIO())
+
+    def test_delete(self):
+        self.backend.write(self.storage_dir, "a.txt", io.BytesIO(b"hello"))
+        self.backend.delete(self.storage_dir, "a.txt")
+        self.assertFalse(self.backend.exists(self.storage_dir, "a.txt"))
+
+    def test_create_never_replaces(self):
+        self.backend.create(self.storage_dir, "v/a/1", io.BytesIO(b"first"))
+        with self.assertRaises(FileExistsError):
+            self.backend.create(self.storage_dir, "v/a/1", io.BytesIO(b"second"))
+        out = io.BytesIO()
+        self.backend.read(self.storage_dir, "v/a/1", out)
+        self.assertEqual(out.getvalue(), b"first")
+
+    def test_rename(self):
+        self.backend.write(self.storage_dir, "v/a/1", io.BytesIO(b"1"))
+        self.backend.write(self.storage_dir, "b", io.BytesIO(b"2"))
+        self.backend.rename(self.storage_dir, "v/a/", "trash/a/")
+        self.backend.rename(self.storage_dir, "b", "trash/b")
+        self.assertEqual(self.backend.list(self.storage_dir), ["trash/a/1", "trash/b"])
+
+
+class TestGetBackend(unittest.TestCase):
+    def tearDown(self):
+        set_backend(None)
+
+    @patch.object(Config, "STORAGE_BACKEND", "local")
+    def test_default_is_local(self):
+        set_backend(None)
+        self.assertIsInstance(get_backend(), LocalStorage)
+
+    @patch.object(Config, "STORAGE_BACKEND", "ftp")
+    def test_unknown_backend(self):
+        set_backend(None)
+        with self.assertRaises(ValueError):
+            get_backend()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+from cryptography.fernet import Fernet
+from encryption import reset_fernet
+from storage import LocalStorage
+from versions import write_version
+import usage
+from usage import (
+    QuotaExceededError,
+    get_usage,
+    update_usage,
+    get_quota,
+    reservation,
+    reconcile,
+)
+
+
+class TestUsage(unittest.TestCase):
+    def setUp(self):
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        self.storage_dir = os.path.join(base, "storage", "alice")
+        os.makedirs(self.storage_dir)
+        self.quotas_file = os.path.join(base, "quotas.json")
+        for name, value in (
+            ("USAGE_DIR", os.path.join(base, "usage")),
+            ("QUOTAS_FILE", self.quotas_file),
+            ("DEFAULT_QUOTA_BYTES", 0),
+        ):
+            config_patch = patch(f"usage.Config.{name}", value)
+            config_patch.start()
+            self.addCleanup(config_patch.stop)
+
+    def test_update_usage(self):
+        self.assertEqual(get_usage(self.storage_dir)["objects"], 0)
+        update_usage(self.storage_dir, objects=2, logical_bytes=10, stored_bytes=30)
+        update_usage(self.storage_dir, objects=-1, logical_bytes=-4)
+        usage = get_usage(self.storage_dir)
+        self.assertEqual(usage["objects"], 1)
+        self.assertEqual(usage["logical_bytes"], 6)
+        self.assertEqual(usage["stored_bytes"], 30)
+
+        # Counters never go negative
+        update_usage(self.storage_dir, objects=-5)
+        self.assertEqual(get_usage(self.storage_dir)["objects"], 0)
+
+    def test_quota_from_file_and_default(self):
+        self.assertEqual(get_quota(self.storage_dir), 0)
+        with patch("usage.Config.DEFAULT_QUOTA_BYTES", 100):
+            self.assertEqual(get_quota(self.storage_dir), 100)
+            with open(self.quotas_file, "w") as f:
+                json.dump({"alice": 50}, f)
+            self.assertEqual(get_quota(self.storage_dir), 50)
+
+    def test_reservation_enforces_quota(self):
+        with open(self.quotas_file, "w") as f:
+            json.dump({"alice": 100}, f)
+        update_usage(self.storage_dir, logical_bytes=60)
+
+        with reservation(self.storage_dir) as first:
+            first(30)
+            # Reservations of concurrent uploads count against the quota too
+            with reservation(self.storage_dir) as second:
+                with self.assertRaises(QuotaExceededError):
+                    second(20)
+                second(10)
+
+        # Released when the uploads finish
+        with reservation(self.storage_dir) as reserve:
+            reserve(40)
+
+    @unittest.skipIf(sys.platform == "win32", "reservations need flock")
+    def test_reservations_of_other_processes(self):
+        with open(self.quotas_file, "w") as f:
+            json.dump({"alice": 100}, f)
+        update_usage(self.storage_dir, logical_bytes=40)
+        usage_dir = usage.Config.USAGE_DIR
+
+        # Another upload holds its reservation file locked while it runs
+        holder = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import fcntl, sys\n"
+                "f = open(sys.argv[1], 'a')\n"
+                "fcntl.flock(f, fcntl.LOCK_EX)\n"
+                "print('locked', flush=True)\n"
+                "sys.stdin.read()\n",
+                os.path.join(usage_dir, "alice.other.reserve"),
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.stdin.close)
+        self.assertEqual(holder.stdout.readline().strip(), "locked")
+        # A crashed upload left its file unlocked; an old entry has no file
+        open(os.path.join(usage_dir, "alice.crashed.reserve"), "w").close()
+        usage_file = os.path.join(usage_dir, "alice.json")
+        with open(usage_file) as f:
+            counters = json.load(f)
+        counters["reservations"] = {
+            "other": {"bytes": 50},
+            "crashed": {"bytes": 1000},
+            "old": {"pid": 1, "bytes": 90},
+        }
+        with open(usage_file, "w") as f:
+            json.dump(counters, f)
+
+        with reservation(self.storage_dir) as reserve:
+            with self.assertRaises(QuotaExceededError):
+                reserve(20)
+            reserve(10)
+            reservations = get_usage(self.storage_dir)["reservations"]
+            self.assertEqual(len(reservations), 2)
+            self.assertIn("other", reservations)
+        self.assertEqual(list(get_usage(self.storage_dir)["reservations"]), ["other"])
+        self.assertFalse(
+            os.path.exists(os.path.join(usage_dir, "alice.crashed.reserve"))
+        )
+
+        # Once the other upload ends, its reservation goes too, also on reconcile
+        holder.stdin.close()
+        holder.wait()
+        _, after = reconcile(self.storage_dir, LocalStorage())
+        self.assertEqual(after["reservations"], {})
+
+    def test_reconcile(self):
+        backend = LocalStorage()
+        with patch("encryption.load_key", return_value=Fernet.generate_key()):
+            reset_fernet()
+            self.addCleanup(reset_fernet)
+            write_version(io.BytesIO(b"hello"), "a", self.storage_dir, backend)
+            write_version(io.BytesIO(b"world!"), "a", self.storage_dir, backend)
+            write_version(io.BytesIO(b"x"), "b", self.storage_dir, backend)
+            update_usage(self.storage_dir, objects=7, logical_bytes=1)
+
+            before, after = reconcile(self.storage_dir, backend)
+
+        self.assertEqual(before["objects"], 7)
+        self.assertEqual(after["objects"], 2)
+        self.assertEqual(after["logical_bytes"], 12)
+        stored = sum(
+            backend.stat(self.storage_dir, key).size
+            for key in backend.list(self.storage_dir)
+        )
+        self.assertEqual(after["stored_bytes"], stored)
+        self.assertEqual(get_usage(self.storage_dir)["objects"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
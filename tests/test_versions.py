@@ -0,0 +1,232 @@
+import io
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from cryptography.fernet import Fernet
+from encryption import reset_fernet
+from config import Config
+from storage import LocalStorage, ObjectInfo
+from versions import (
+    CHUNKS_PREFIX,
+    chunk_key,
+    write_version,
+    read_manifest,
+    read_chunk_data,
+    list_versions,
+    prune_versions,
+    collect_garbage,
+    bounded_map,
+    new_trash_id,
+    trash_object,
+    list_trash,
+    restore_object,
+    purge_trash,
+)
+
+
+class TestVersions(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_dir)
+        self.backend = LocalStorage()
+        key_patch = patch("encryption.load_key", return_value=Fernet.generate_key())
+        key_patch.start()
+        self.addCleanup(key_patch.stop)
+        reset_fernet()
+        self.addCleanup(reset_fernet)
+
+    def write(self, data, name="f"):
+        manifest, _, _ = write_version(
+            io.BytesIO(data), name, self.storage_dir, self.backend
+        )
+        return manifest
+
+    def test_concurrent_uploads_get_distinct_versions(self):
+        barrier = threading.Barrier(4)
+
+        class Source(io.BytesIO):
+            def read(self, *args):
+                # Every upload has listed the (empty) versions before any stores
+                barrier.wait(timeout=5)
+                return super().read(*args)
+
+        def upload(i):
+            return write_version(
+                Source(b"data %d" % i), "f", self.storage_dir, self.backend
+            )
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(upload, range(4)))
+        self.assertEqual(
+            sorted(manifest["version"] for manifest, _, _ in results), [1, 2, 3, 4]
+        )
+        self.assertEqual([created for _, _, created in results].count(True), 1)
+        self.assertEqual(
+            list_versions("f", self.storage_dir, self.backend), [1, 2, 3, 4]
+        )
+        for manifest, _, _ in results:
+            stored = read_manifest(
+                "f", manifest["version"], self.storage_dir, self.backend
+            )
+            self.assertEqual(stored["chunks"], manifest["chunks"])
+
+    @unittest.skipIf(sys.platform == "win32", "the store lock needs flock")
+    def test_uploads_wait_for_collection_in_other_processes(self):
+        holder = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import fcntl, sys, time\n"
+                "f = open(sys.argv[1], 'a')\n"
+                "fcntl.flock(f, fcntl.LOCK_EX)\n"
+                "print('locked', flush=True)\n"
+                "time.sleep(0.5)\n",
+                Config.STORE_LOCK_FILE,
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.addCleanup(holder.wait)
+        self.assertEqual(holder.stdout.readline().strip(), "locked")
+        start = time.monotonic()
+        self.write(b"data")
+        self.assertGreater(time.monotonic() - start, 0.3)
+
+    def test_versions_continue_past_trashed_ones(self):
+        self.write(b"one")
+        self.write(b"two")
+        trash_object("f", new_trash_id(), self.storage_dir, self.backend)
+        self.assertEqual(self.write(b"three")["version"], 3)
+
+        # A new name only looks at its own part of the trash
+        with patch.object(self.backend, "list", wraps=self.backend.list) as listing:
+            self.assertEqual(self.write(b"new", name="g")["version"], 1)
+        self.assertNotIn(".sfss/trash/", [c.args[1] for c in listing.call_args_list])
+        self.assertIn(
+            ".sfss/trash/versions/g/", [c.args[1] for c in listing.call_args_list]
+        )
+
+    def test_identical_upload_stores_no_new_chunks(self):
+        _, stored, created = write_version(
+            io.BytesIO(b"same"), "f", self.storage_dir, self.backend
+        )
+        self.assertTrue(created)
+        self.assertGreater(stored, 0)
+        _, stored, created = write_version(
+            io.BytesIO(b"same"), "f", self.storage_dir, self.backend
+        )
+        self.assertFalse(created)
+        # Only the new manifest was stored
+        manifest_key = self.backend.list(self.storage_dir, ".sfss/versions/")[-1]
+        self.assertEqual(stored, self.backend.stat(self.storage_dir, manifest_key).size)
+        self.assertEqual(len(self.backend.list(self.storage_dir, CHUNKS_PREFIX)), 1)
+        self.assertEqual(list_versions("f", self.storage_dir, self.backend), [1, 2])
+
+    def test_empty_upload(self):
+        manifest = self.write(b"")
+        self.assertEqual(manifest["chunks"], [])
+        self.assertEqual(manifest["size"], 0)
+
+    @patch("versions.Config.CHUNK_SIZE", 4)
+    def test_swapped_chunk_fails_integrity_check(self):
+        manifest = self.write(b"aaaabbbb")
+        (first, _), (second, _) = manifest["chunks"]
+        # Replace the first chunk with the (validly encrypted) second one
+        out = io.BytesIO()
+        self.backend.read(self.storage_dir, chunk_key(second), out)
+        self.backend.write(
+            self.storage_dir, chunk_key(first), io.BytesIO(out.getvalue())
+        )
+        with self.assertRaises(ValueError):
+            read_chunk_data(first, self.storage_dir, self.backend)
+
+    def test_prune_keep_last(self):
+        for i in range(5):
+            self.write(str(i).encode())
+        removed = prune_versions(
+            self.storage_dir, self.backend, keep_last=2, keep_days=0
+        )
+        self.assertEqual(removed["versions"], 3)
+        self.assertEqual(removed["logical_bytes"], 3)
+        self.assertEqual(list_versions("f", self.storage_dir, self.backend), [4, 5])
+
+    def test_prune_keep_days_keeps_latest(self):
+        for i in range(3):
+            self.write(str(i).encode())
+        old = ObjectInfo(1, time.time() - 10 * 86400, "x")
+        with patch.object(self.backend, "stat", return_value=old):
+            removed = prune_versions(
+                self.storage_dir, self.backend, keep_last=0, keep_days=7
+            )
+        self.assertEqual(removed["versions"], 2)
+        self.assertEqual(list_versions("f", self.storage_dir, self.backend), [3])
+
+    def test_reserve_can_abort_upload(self):
+        def reserve(n):
+            raise RuntimeError("over quota")
+
+        with self.assertRaises(RuntimeError):
+            write_version(
+                io.BytesIO(b"data"), "f", self.storage_dir, self.backend, reserve
+            )
+        self.assertEqual(self.backend.list(self.storage_dir), [])
+
+    @patch("versions.Config.CHUNK_SIZE", 4)
+    def test_collect_garbage(self):
+        self.write(b"aaaabbbb")
+        self.write(b"aaaacccc")
+        prune_versions(self.storage_dir, self.backend, keep_last=1, keep_days=0)
+
+        # Fresh chunks are inside the grace period and survive
+        self.assertEqual(collect_garbage(self.storage_dir, self.backend), (0, 0))
+
+        with patch("versions.Config.GC_GRACE_SECONDS", -1):
+            removed, reclaimed = collect_garbage(self.storage_dir, self.backend)
+        self.assertEqual(removed, 1)  # Only "bbbb" is unreferenced
+        self.assertGreater(reclaimed, 0)
+        manifest = read_manifest("f", 2, self.storage_dir, self.backend)
+        for cid, _ in manifest["chunks"]:
+            read_chunk_data(cid, self.storage_dir, self.backend)
+
+    @patch("versions.Config.GC_GRACE_SECONDS", -1)
+    def test_trash_keeps_chunks_until_purged(self):
+        self.write(b"keep me")
+        self.assertEqual(
+            trash_object("f", new_trash_id(), self.storage_dir, self.backend), 7
+        )
+        self.assertEqual(list_versions("f", self.storage_dir, self.backend), [])
+        self.assertEqual(collect_garbage(self.storage_dir, self.backend), (0, 0))
+
+        # Still inside the grace period
+        self.assertEqual(purge_trash(self.storage_dir, self.backend)[0], 0)
+        (entry,) = list_trash(self.storage_dir, self.backend)
+        self.assertEqual(entry["name"], "f")
+
+        restore_object(entry, self.storage_dir, self.backend)
+        self.assertEqual(list_versions("f", self.storage_dir, self.backend), [1])
+        trash_object("f", new_trash_id(), self.storage_dir, self.backend)
+
+        with patch("versions.time.sleep") as sleep:
+            purged, freed = purge_trash(
+                self.storage_dir, self.backend, grace=-1, rate=1000
+            )
+        self.assertEqual(purged, 1)
+        self.assertGreater(freed, 0)
+        self.assertEqual(list_trash(self.storage_dir, self.backend), [])
+        self.assertEqual(collect_garbage(self.storage_dir, self.backend)[0], 1)
+        sleep.assert_called()
+
+    def test_bounded_map_keeps_order(self):
+        self.assertEqual(
+            list(bounded_map(lambda x: x * 2, range(10), 3)), list(range(0, 20, 2))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
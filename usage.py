@@ -0,0 +1,217 @@
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from config import Config
+from logger import logger
+from versions import list_objects, list_versions, version_size, lock_store
+
+try:
+    import fcntl
+except ImportError:  # Windows: counters are only locked within one process
+    fcntl = None
+
+# Per-user counters live next to the tokens, outside the (possibly remote)
+# object store, in USAGE_DIR/<username>.json:
+#
+#   {"objects": 3, "logical_bytes": 1200, "stored_bytes": 1700, "updated": ...,
+#    "reservations": {"<id>": {"bytes": 4194304}}}
+#
+# logical_bytes is the plaintext size of every stored version, stored_bytes
+# what the encrypted manifests and chunks take up in the backend.
+# reservations hold the quota claimed by uploads in flight, in any process.
+# Each upload holds a flock on USAGE_DIR/<username>.<id>.reserve for as long
+# as its reservation lasts, so the lock, and the reservation, end with it.
+COUNTERS = ("objects", "logical_bytes", "stored_bytes")
+
+_lock = threading.Lock()
+_held = {}  # reservation id -> open, locked .reserve file of this process
+
+
+class QuotaExceededError(Exception):
+    pass
+
+
+def _username(storage_dir):
+    return os.path.basename(os.path.normpath(storage_dir))
+
+
+def _usage_path(storage_dir):
+    return os.path.join(Config.USAGE_DIR, f"{_username(storage_dir)}.json")
+
+
+@contextmanager
+def _locked(storage_dir):
+    """Serialize counter updates across threads and processes."""
+    os.makedirs(Config.USAGE_DIR, exist_ok=True)
+    with _lock, open(_usage_path(storage_dir) + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _reserve_path(storage_dir, rid):
+    return os.path.join(Config.USAGE_DIR, f"{_username(storage_dir)}.{rid}.reserve")
+
+
+def _is_held(storage_dir, rid):
+    """Whether the upload that made reservation `rid` is still running."""
+    if rid in _held or fcntl is None:
+        # Without flock, only reservations of this process can be verified
+        return rid in _held
+    path = _reserve_path(storage_dir, rid)
+    try:
+        f = open(path, "r")
+    except OSError:
+        return False
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    # Nobody holds it any more: the upload crashed
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return False
+
+
+def _read(storage_dir):
+    try:
+        with open(_usage_path(storage_dir), "r") as f:
+            usage = json.load(f)
+    except FileNotFoundError:
+        usage = {}
+    for counter in COUNTERS:
+        usage.setdefault(counter, 0)
+    usage.setdefault("updated", None)
+    # Reservations of uploads that died, or that cannot be verified, are dropped
+    usage["reservations"] = {
+        rid: r
+        for rid, r in usage.get("reservations", {}).items()
+        if _is_held(storage_dir, rid)
+    }
+    return usage
+
+
+def _write(storage_dir, usage):
+    usage["updated"] = time.time()
+    fd, tmp_path = tempfile.mkstemp(dir=Config.USAGE_DIR, prefix=".usage-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(usage, f)
+        os.replace(tmp_path, _usage_path(storage_dir))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_usage(storage_dir):
+    """Current counters of the user owning `storage_dir`, without touching storage."""
+    return _read(storage_dir)
+
+
+def update_usage(storage_dir, objects=0, logical_bytes=0, stored_bytes=0):
+    """Apply deltas to the counters in a single locked read-modify-write."""
+    with _locked(storage_dir):
+        usage = _read(storage_dir)
+        usage["objects"] += objects
+        usage["logical_bytes"] += logical_bytes
+        usage["stored_bytes"] += stored_bytes
+        # Deltas may race with a reconcile; never report negative usage
+        for counter in COUNTERS:
+            usage[counter] = max(0, usage[counter])
+        _write(storage_dir, usage)
+    return usage
+
+
+def get_quota(storage_dir):
+    """Logical byte quota of the user owning `storage_dir`, or 0 for none."""
+    try:
+        with open(Config.QUOTAS_FILE, "r") as f:
+            quotas = json.load(f)
+    except FileNotFoundError:
+        quotas = {}
+    return int(quotas.get(_username(storage_dir), Config.DEFAULT_QUOTA_BYTES))
+
+
+@contextmanager
+def reservation(storage_dir):
+    """Yield a reserve(n) callback that claims quota before n bytes are written.
+
+    reserve() raises QuotaExceededError if the user's stored data plus
+    everything reserved by other uploads, in this or any other process,
+    would exceed the quota. Reservations are kept in the usage file under
+    its lock and released when the block exits, so record what was actually
+    stored with update_usage() before leaving it.
+    """
+    quota = get_quota(storage_dir)
+    rid = secrets.token_hex(8)
+    reserved = False
+
+    def reserve(n):
+        nonlocal reserved
+        if not quota:
+            return
+        with _locked(storage_dir):
+            usage = _read(storage_dir)
+            pending = usage["reservations"]
+            used = usage["logical_bytes"] + sum(r["bytes"] for r in pending.values())
+            if used + n > quota:
+                raise QuotaExceededError(
+                    f"Quota exceeded: {used + n} of {quota} bytes would be used."
+                )
+            if rid not in _held:
+                held = open(_reserve_path(storage_dir, rid), "a")
+                if fcntl is not None:
+                    fcntl.flock(held, fcntl.LOCK_EX)
+                _held[rid] = held
+            pending.setdefault(rid, {"bytes": 0})["bytes"] += n
+            _write(storage_dir, usage)
+            reserved = True
+
+    try:
+        yield reserve
+    finally:
+        if reserved:
+            with _locked(storage_dir):
+                usage = _read(storage_dir)
+                usage["reservations"].pop(rid, None)
+                _write(storage_dir, usage)
+                _held.pop(rid).close()
+                os.remove(_reserve_path(storage_dir, rid))
+
+
+def reconcile(storage_dir, backend):
+    """Recount usage from the store itself, e.g. after a crash mid-upload.
+
+    Returns the counters before and after.
+    """
+    with lock_store(), _locked(storage_dir):
+        before = _read(storage_dir)
+        names = list_objects(storage_dir, backend)
+        logical = 0
+        for name in names:
+            for version in list_versions(name, storage_dir, backend):
+                logical += version_size(name, version, storage_dir, backend)[0]
+        stored = 0
+        for key in backend.list(storage_dir):
+            info = backend.stat(storage_dir, key)
+            stored += info.size if info else 0
+        # _read() has already dropped every reservation it could not verify
+        after = dict(
+            before, objects=len(names), logical_bytes=logical, stored_bytes=stored
+        )
+        _write(storage_dir, after)
+    if any(before[c] != after[c] for c in COUNTERS):
+        logger.info(f"Reconciled usage of {_username(storage_dir)}: {after}")
+    return before, after
@@ -0,0 +1,508 @@
+import hmac
+import io
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from delta import weak_checksum, signatures, delta_chunks
+from encryption import get_fernet, chunk_id, read_chunk
+from logger import logger
+from metrics import phase, add_bytes, run_in_context
+
+try:
+    import fcntl
+except ImportError:  # Windows: the store is only locked within one process
+    fcntl = None
+
+# Every upload stores an immutable manifest listing the object's chunks:
+#
+#   .sfss/versions/<name>/<version>   encrypted JSON manifest
+#   .sfss/chunks/<id[:2]>/<id>        encrypted chunk, shared by all versions
+#
+# Files stored before versioning sit at <name> and are shown as version 0.
+# Deleted objects are moved, not removed, until the trash is purged:
+#
+#   .sfss/trash/versions/<name>/<trash id>/<version>
+#   .sfss/trash/legacy/<name>/<trash id>
+#
+# Keyed by name first, so the trashed versions of one name are a single
+# short listing.
+META_PREFIX = ".sfss"
+VERSIONS_PREFIX = ".sfss/versions/"
+CHUNKS_PREFIX = ".sfss/chunks/"
+TRASH_PREFIX = ".sfss/trash/"
+TRASH_VERSIONS_PREFIX = ".sfss/trash/versions/"
+TRASH_LEGACY_PREFIX = ".sfss/trash/legacy/"
+LEGACY_VERSION = 0
+
+
+class _StoreLock:
+    """Uploads share the store; garbage collection needs it to itself.
+
+    Threads of one process are coordinated here; between processes, the
+    process holds a shared or exclusive flock on Config.STORE_LOCK_FILE
+    while any of its threads hold the lock.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._writers = 0
+        self._collecting = False
+        self._file = None
+
+    def _flock(self, operation):
+        if fcntl is None:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(Config.STORE_LOCK_FILE), exist_ok=True)
+            self._file = open(Config.STORE_LOCK_FILE, "a")
+        fcntl.flock(self._file, getattr(fcntl, operation))
+
+    def acquire_shared(self):
+        with self._cond:
+            while self._collecting:
+                self._cond.wait()
+            if not self._writers:
+                self._flock("LOCK_SH")
+            self._writers += 1
+
+    def release_shared(self):
+        with self._cond:
+            self._writers -= 1
+            if not self._writers:
+                self._flock("LOCK_UN")
+            self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        with self._cond:
+            while self._collecting or self._writers:
+                self._cond.wait()
+            self._flock("LOCK_EX")
+            self._collecting = True
+
+    def release_exclusive(self):
+        with self._cond:
+            self._flock("LOCK_UN")
+            self._collecting = False
+            self._cond.notify_all()
+
+
+_store_lock = _StoreLock()
+
+
+@contextmanager
+def lock_store(shared=False):
+    """Hold off uploads in this process, e.g. while scanning the whole store.
+
+    With `shared`, only hold off garbage collection, e.g. while reading it.
+    """
+    if shared:
+        _store_lock.acquire_shared()
+    else:
+        _store_lock.acquire_exclusive()
+    try:
+        yield
+    finally:
+        if shared:
+            _store_lock.release_shared()
+        else:
+            _store_lock.release_exclusive()
+
+
+def bounded_map(func, items, workers):
+    """Like Executor.map, but only keeps a window of items in flight.
+
+    Results are yielded in input order and at most 2 * workers items are
+    held in memory, however long `items` is.
+    """
+    workers = max(1, workers)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append(run_in_context(executor, func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _iter_chunks(source, size):
+    while True:
+        with phase("source_read"):
+            chunk = read_chunk(source, size)
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < size:
+            return
+
+
+def chunk_key(cid):
+    # Fan chunks out over 256 sub-directories to keep directory listings small
+    return f"{CHUNKS_PREFIX}{cid[:2]}/{cid}"
+
+
+def manifest_key(name, version):
+    return f"{VERSIONS_PREFIX}{name}/{version:08d}"
+
+
+def list_objects(storage_dir, backend):
+    """Names of all stored objects, versioned or legacy."""
+    names = {
+        key[len(VERSIONS_PREFIX) :].split("/")[0]
+        for key in backend.list(storage_dir, VERSIONS_PREFIX)
+    }
+    names.update(backend.list(storage_dir, recursive=False))
+    return sorted(names)
+
+
+def list_versions(name, storage_dir, backend):
+    prefix = f"{VERSIONS_PREFIX}{name}/"
+    versions = [int(key[len(prefix) :]) for key in backend.list(storage_dir, prefix)]
+    if backend.exists(storage_dir, name):
+        versions.append(LEGACY_VERSION)
+    return sorted(versions)
+
+
+def _load_manifest(key, storage_dir, backend):
+    buf = io.BytesIO()
+    backend.read(storage_dir, key, buf)
+    return json.loads(get_fernet().decrypt(buf.getvalue()))
+
+
+def read_manifest(name, version, storage_dir, backend):
+    if version == LEGACY_VERSION:
+        info = backend.stat(storage_dir, name)
+        if info is None:
+            raise FileNotFoundError("Version does not exist.")
+        # Legacy objects are single encrypted blobs; their plaintext size is unknown
+        return {"name": name, "version": 0, "created": info.modified, "legacy": True}
+    return _load_manifest(manifest_key(name, version), storage_dir, backend)
+
+
+def next_version(name, versions, storage_dir, backend):
+    """First version number after `versions`, the live versions of `name`."""
+    if versions and versions[-1] != LEGACY_VERSION:
+        return versions[-1] + 1
+    # Keep numbering past copies in the trash, so deleting an object does not
+    # make its version numbers available again
+    prefix = f"{TRASH_VERSIONS_PREFIX}{name}/"
+    trashed = [int(key.rpartition("/")[2]) for key in backend.list(storage_dir, prefix)]
+    return max(trashed, default=LEGACY_VERSION) + 1
+
+
+def store_manifest(manifest, storage_dir, backend):
+    """Store `manifest` under the first free version number from its own.
+
+    The manifest key is claimed with backend.create(), so concurrent uploads
+    of one name never overwrite each other's versions. Updates
+    manifest["version"] and returns the stored size.
+    """
+    fernet = get_fernet()
+    while True:
+        token = fernet.encrypt(json.dumps(manifest).encode())
+        key = manifest_key(manifest["name"], manifest["version"])
+        try:
+            backend.create(storage_dir, key, io.BytesIO(token))
+            return len(token)
+        except FileExistsError:
+            manifest["version"] += 1
+
+
+def write_version(source, name, storage_dir, backend, reserve=None, delta=False):
+    """Store everything readable from `source` as a new version of `name`.
+
+    Chunks already in the store are referenced rather than written again, so
+    an upload only costs storage for the chunks that changed. With `delta`,
+    the data is split into DELTA_BLOCK_SIZE blocks, and blocks of the latest
+    version are also found when they moved, e.g. after an insertion.
+    `reserve`, if given, is called with each chunk's size
+    before it is stored and may raise to abort the upload.
+
+    Returns (manifest, bytes newly stored, whether `name` is a new object).
+    """
+    fernet = get_fernet()
+    block_size = Config.DELTA_BLOCK_SIZE if delta else Config.CHUNK_SIZE
+    _store_lock.acquire_shared()
+    try:
+        versions = list_versions(name, storage_dir, backend)
+        known = set()
+        blocks = None
+        if versions and versions[-1] != LEGACY_VERSION:
+            latest = read_manifest(name, versions[-1], storage_dir, backend)
+            known = {cid for cid, _ in latest["chunks"]}
+            if delta:
+                blocks = signatures(latest, block_size)
+        if delta and not blocks:
+            logger.info(f"No block signatures for {name}, uploading it in full.")
+
+        stored = 0
+        stored_lock = threading.Lock()
+
+        def store(chunk):
+            nonlocal stored
+            if isinstance(chunk, list):
+                # Block of the latest version matched by a delta upload
+                add_bytes("matched", chunk[1])
+                return chunk
+            with phase("hash"):
+                cid = chunk_id(chunk)
+                weak = weak_checksum(chunk)
+            add_bytes("plaintext", len(chunk))
+            key = chunk_key(cid)
+            if cid not in known and not backend.exists(storage_dir, key):
+                with phase("encrypt"):
+                    token = fernet.encrypt(chunk)
+                backend.write(storage_dir, key, io.BytesIO(token))
+                add_bytes("stored", len(token))
+                with stored_lock:
+                    stored += len(token)
+            return [cid, len(chunk), weak]
+
+        def chunks_to_store():
+            if blocks:
+                pieces = delta_chunks(source, blocks, block_size)
+            else:
+                pieces = _iter_chunks(source, block_size)
+            for chunk in pieces:
+                if reserve is not None:
+                    reserve(chunk[1] if isinstance(chunk, list) else len(chunk))
+                yield chunk
+
+        results = list(bounded_map(store, chunks_to_store(), Config.CHUNK_CONCURRENCY))
+        chunks = [[cid, length] for cid, length, _ in results]
+        manifest = {
+            "name": name,
+            "version": next_version(name, versions, storage_dir, backend),
+            "created": time.time(),
+            "size": sum(length for _, length in chunks),
+            "chunks": chunks,
+            # Block signatures for delta uploads of the next version
+            "weak": [weak for _, _, weak in results],
+        }
+        stored += store_manifest(manifest, storage_dir, backend)
+        version = manifest["version"]
+        # Of concurrent first uploads of a name, only the lowest version is new
+        created = not versions and not any(
+            v < version for v in list_versions(name, storage_dir, backend)
+        )
+    finally:
+        _store_lock.release_shared()
+    logger.info(f"Stored version {version} of {name} ({len(chunks)} chunks).")
+    return manifest, stored, created
+
+
+def read_chunk_data(cid, storage_dir, backend):
+    buf = io.BytesIO()
+    backend.read(storage_dir, chunk_key(cid), buf)
+    with phase("decrypt"):
+        data = get_fernet().decrypt(buf.getvalue())
+    # A chunk swapped for another valid one would still decrypt; its id must match
+    with phase("hash"):
+        valid = hmac.compare_digest(chunk_id(data), cid)
+    if not valid:
+        raise ValueError(f"Chunk {cid} failed its integrity check.")
+    return data
+
+
+def read_version(manifest, dest, storage_dir, backend):
+    """Write the plaintext of a (non-legacy) version to `dest`."""
+    chunks = (cid for cid, _ in manifest["chunks"])
+    for data in bounded_map(
+        lambda cid: read_chunk_data(cid, storage_dir, backend),
+        chunks,
+        Config.CHUNK_CONCURRENCY,
+    ):
+        with phase("sink_write"):
+            dest.write(data)
+        add_bytes("plaintext", len(data))
+
+
+def version_size(name, version, storage_dir, backend):
+    """(logical bytes, stored bytes of the manifest or legacy object)."""
+    key = name if version == LEGACY_VERSION else manifest_key(name, version)
+    info = backend.stat(storage_dir, key)
+    if info is None:
+        return 0, 0
+    if version == LEGACY_VERSION:
+        # Legacy objects are opaque; count their stored size as logical size
+        return info.size, info.size
+    return read_manifest(name, version, storage_dir, backend)["size"], info.size
+
+
+def delete_versions(name, versions, storage_dir, backend):
+    """Drop manifests; their chunks are reclaimed by collect_garbage().
+
+    Returns the (logical bytes, stored bytes) freed.
+    """
+    logical = stored = 0
+    for version in versions:
+        version_logical, version_stored = version_size(
+            name, version, storage_dir, backend
+        )
+        if version == LEGACY_VERSION:
+            backend.delete(storage_dir, name)
+        else:
+            backend.delete(storage_dir, manifest_key(name, version))
+        logical += version_logical
+        stored += version_stored
+    return logical, stored
+
+
+def prune_versions(storage_dir, backend, name=None, keep_last=None, keep_days=None):
+    """Apply the retention policy to one object, or to all of them.
+
+    Returns the number of versions removed and the bytes they freed.
+    """
+    keep_last = Config.KEEP_VERSIONS if keep_last is None else keep_last
+    keep_days = Config.KEEP_DAYS if keep_days is None else keep_days
+    names = [name] if name else list_objects(storage_dir, backend)
+    now = time.time()
+    result = {"versions": 0, "logical_bytes": 0, "stored_bytes": 0}
+    for obj in names:
+        versions = list_versions(obj, storage_dir, backend)
+        # The newest version is never pruned
+        candidates = versions[:-1]
+        expired = set()
+        if keep_last:
+            expired.update(candidates[: max(0, len(candidates) - keep_last + 1)])
+        if keep_days:
+            for version in candidates:
+                key = obj if version == LEGACY_VERSION else manifest_key(obj, version)
+                info = backend.stat(storage_dir, key)
+                if info and now - info.modified > keep_days * 86400:
+                    expired.add(version)
+        if expired:
+            logical, stored = delete_versions(
+                obj, sorted(expired), storage_dir, backend
+            )
+            result["versions"] += len(expired)
+            result["logical_bytes"] += logical
+            result["stored_bytes"] += stored
+            logger.info(f"Pruned {len(expired)} old version(s) of {obj}.")
+    return result
+
+
+def new_trash_id():
+    # Deletion time first, so ids sort by age
+    return f"{int(time.time())}-{secrets.token_hex(4)}"
+
+
+def trash_object(name, trash_id, storage_dir, backend):
+    """Move every version of `name` to the trash, returning their logical bytes.
+
+    Versioned objects move with a single rename of their manifest directory.
+    """
+    versions = list_versions(name, storage_dir, backend)
+    logical = sum(version_size(name, v, storage_dir, backend)[0] for v in versions)
+    if versions and versions[-1] != LEGACY_VERSION:
+        backend.rename(
+            storage_dir,
+            f"{VERSIONS_PREFIX}{name}/",
+            f"{TRASH_VERSIONS_PREFIX}{name}/{trash_id}/",
+        )
+    if LEGACY_VERSION in versions:
+        backend.rename(storage_dir, name, f"{TRASH_LEGACY_PREFIX}{name}/{trash_id}")
+    return logical
+
+
+def list_trash(storage_dir, backend):
+    """Trashed objects, oldest deletion first."""
+    entries = {}
+    for key in backend.list(storage_dir, TRASH_PREFIX):
+        kind, name, trash_id = key[len(TRASH_PREFIX) :].split("/")[:3]
+        entry = entries.setdefault(
+            (trash_id, name),
+            {
+                "name": name,
+                "trash_id": trash_id,
+                "deleted": int(trash_id.split("-")[0]),
+                "keys": [],
+            },
+        )
+        entry["keys"].append(key)
+    return sorted(entries.values(), key=lambda e: (e["trash_id"], e["name"]))
+
+
+def restore_object(entry, storage_dir, backend):
+    """Move a trashed object back, returning its logical bytes."""
+    name = entry["name"]
+    if list_versions(name, storage_dir, backend):
+        raise FileExistsError(f"{name} exists.")
+    trashed = f"{TRASH_VERSIONS_PREFIX}{name}/{entry['trash_id']}/"
+    if any(key.startswith(trashed) for key in entry["keys"]):
+        backend.rename(storage_dir, trashed, f"{VERSIONS_PREFIX}{name}/")
+    legacy = f"{TRASH_LEGACY_PREFIX}{name}/{entry['trash_id']}"
+    if legacy in entry["keys"]:
+        backend.rename(storage_dir, legacy, name)
+    return sum(
+        version_size(name, v, storage_dir, backend)[0]
+        for v in list_versions(name, storage_dir, backend)
+    )
+
+
+def purge_trash(storage_dir, backend, grace=None, rate=None):
+    """Permanently delete objects trashed more than `grace` seconds ago.
+
+    Deletes at most `rate` keys per second so a large purge does not starve
+    other I/O. Returns (objects purged, bytes freed).
+    """
+    grace = Config.TRASH_GRACE_SECONDS if grace is None else grace
+    rate = Config.PURGE_RATE if rate is None else rate
+    now = time.time()
+    purged = freed = 0
+    next_delete = time.monotonic()
+    for entry in list_trash(storage_dir, backend):
+        if now - entry["deleted"] < grace:
+            continue
+        for key in entry["keys"]:
+            if rate:
+                time.sleep(max(0, next_delete - time.monotonic()))
+                next_delete = max(next_delete, time.monotonic()) + 1 / rate
+            info = backend.stat(storage_dir, key)
+            backend.delete(storage_dir, key)
+            freed += info.size if info else 0
+        purged += 1
+    if purged:
+        backend.cleanup(storage_dir, TRASH_PREFIX)
+        logger.info(f"Purged {purged} deleted object(s) from the trash.")
+    return purged, freed
+
+
+def collect_garbage(storage_dir, backend):
+    """Delete chunks no manifest references any more.
+
+    Returns (chunks removed, bytes reclaimed).
+    """
+    with lock_store():
+        referenced = set()
+        for name in list_objects(storage_dir, backend):
+            for version in list_versions(name, storage_dir, backend):
+                if version != LEGACY_VERSION:
+                    manifest = read_manifest(name, version, storage_dir, backend)
+                    referenced.update(cid for cid, _ in manifest["chunks"])
+        # Deleted objects can still be undeleted until the trash is purged
+        for key in backend.list(storage_dir, TRASH_VERSIONS_PREFIX):
+            manifest = _load_manifest(key, storage_dir, backend)
+            referenced.update(cid for cid, _ in manifest["chunks"])
+
+        now = time.time()
+        removed = reclaimed = 0
+        for key in backend.list(storage_dir, CHUNKS_PREFIX):
+            if key.rpartition("/")[2] in referenced:
+                continue
+            info = backend.stat(storage_dir, key)
+            # Other processes may be mid-upload; leave their fresh chunks alone
+            if info is None or now - info.modified < Config.GC_GRACE_SECONDS:
+                continue
+            backend.delete(storage_dir, key)
+            removed += 1
+            reclaimed += info.size
+    if removed:
+        logger.info(f"Reclaimed {removed} unreferenced chunk(s), {reclaimed} bytes.")
+    return removed, reclaimed